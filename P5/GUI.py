@@ -1,3 +1,6 @@
+import queue
+import threading
+import time
 import numpy as np
 import cv2
 import MAP
@@ -6,17 +9,156 @@ from HAL import HAL
 # Window name
 WINDOW_NAME = "NU GUI"
 
+# Particle density heatmap: size of its cells (in map cells), colormap and opacity
+HEATMAP_CELL_SIZE = 5
+HEATMAP_COLORMAP = cv2.COLORMAP_JET
+HEATMAP_ALPHA = 0.6
+
+# Video encoding of the recorded GUI frames
+VIDEO_FOURCC = "mp4v"
+VIDEO_FPS = 10
+# Max number of frames waiting to be encoded (new frames are dropped when full)
+VIDEO_QUEUE_SIZE = 64
+
+# Max frame rate of the render thread
+RENDER_FPS = 30
+
+class Mailbox:
+    """ Lock-free single-slot mailbox between one writer and one reader thread.
+        The writer replaces the slot with its latest item and never waits,
+        the reader gets the latest item and skips the ones overwritten before it looked.
+        Replacing the slot is a single reference assignment, which is atomic in Python.
+    """
+    def __init__(self):
+        # (sequence number, item) of the latest item
+        self.slot = (0, None)
+
+    def put(self, item):
+        """ Replace the item in the slot (writer thread only) """
+        self.slot = (self.slot[0] + 1, item)
+
+    def get(self):
+        """ Returns the (sequence number, item) of the latest item """
+        return self.slot
+
+class RenderThread(threading.Thread):
+    """ Background thread that draws the snapshots published in the GUI mailbox
+        at most at "fps" frames per second, so the drawing, the video and
+        the window events do not block the simulation loop.
+    """
+    def __init__(self, gui, fps=RENDER_FPS):
+        super().__init__(daemon=True)
+        self.gui = gui
+        self.frame_period = 1.0 / fps
+        self.stopped = threading.Event()
+        self.rendered_frames = 0
+        self.start()
+
+    def run(self):
+        last_sequence = 0
+        while not self.stopped.is_set():
+            frame_start = time.perf_counter()
+            sequence, snapshot = self.gui.mailbox.get()
+            if sequence != last_sequence:
+                last_sequence = sequence
+                self.gui.drawFrame(*snapshot)
+                self.gui.showFrame()
+                self.rendered_frames += 1
+            elif self.gui.window_open:
+                # Keep the window responsive while there are no new snapshots
+                cv2.waitKey(1)
+            self.stopped.wait(max(0.0, self.frame_period - (time.perf_counter() - frame_start)))
+        # The window belongs to this thread
+        if self.gui.window_open:
+            cv2.destroyWindow(WINDOW_NAME)
+            self.gui.window_open = False
+
+    def close(self):
+        """ Stop rendering and wait for the current frame """
+        self.stopped.set()
+        self.join()
+
+class VideoWriterThread(threading.Thread):
+    """ Background thread that encodes the GUI frames into a video file,
+        so the encoding does not block the simulation loop.
+    """
+    def __init__(self, video_file, frame_size, fps=VIDEO_FPS):
+        super().__init__(daemon=True)
+        self.writer = cv2.VideoWriter(video_file, cv2.VideoWriter_fourcc(*VIDEO_FOURCC), fps, frame_size)
+        self.frames = queue.Queue(maxsize=VIDEO_QUEUE_SIZE)
+        self.dropped_frames = 0
+        self.start()
+
+    def write(self, frame):
+        """ Queue a frame to be encoded. The frame is dropped if the queue is full. """
+        try:
+            self.frames.put_nowait(frame)
+        except queue.Full:
+            self.dropped_frames += 1
+
+    def run(self):
+        while True:
+            frame = self.frames.get()
+            if frame is None:
+                break
+            self.writer.write(frame)
+        self.writer.release()
+
+    def close(self):
+        """ Encode the queued frames and close the video file """
+        self.frames.put(None)
+        self.join()
+
+def arrowPolylines(map_poses, arrow_length, tip_length=0.3):
+    """ Returns an (N, 5, 2) array with one arrow polyline per map pose (x, y, yaw):
+        start -> end -> left tip -> end -> right tip, as drawn by cv2.arrowedLine.
+    """
+    start = map_poses[:, :2].astype(int)
+    yaw = map_poses[:, 2]
+    end = (start + arrow_length * np.column_stack((np.cos(yaw), np.sin(yaw)))).astype(int)
+    # Tips at +-45º from the arrow, pointing backwards from the end
+    tip_size = arrow_length * tip_length
+    angle = np.arctan2(start[:, 1] - end[:, 1], start[:, 0] - end[:, 0])
+    left_tip = end + tip_size * np.column_stack((np.cos(angle + np.pi/4), np.sin(angle + np.pi/4)))
+    right_tip = end + tip_size * np.column_stack((np.cos(angle - np.pi/4), np.sin(angle - np.pi/4)))
+    polylines = np.stack((start, end, np.rint(left_tip), end, np.rint(right_tip)), axis=1)
+    return polylines.astype(np.int32)
+
 class GUI:
     """ Class to emulate unibotics GUI API """
-    def __init__(self, robot=None):
-        """ Read the map and initialize variables """
-        self.map = MAP.getMap()
+    def __init__(self, robot=None, headless=False, render_every=1, video_file=None, particle_view="arrows",
+                 render_thread=False, render_fps=RENDER_FPS):
+        """ Read the map and initialize variables.
+            Set "headless" to True to never open a window (e.g. on servers without display),
+            "render_every" to draw only one of every N updates and "video_file"
+            to record the drawn frames in a video.
+            "particle_view" selects how particles are drawn: "arrows" (one per particle)
+            or "heatmap" (particle density, for large numbers of particles).
+            Set "render_thread" to draw in a background thread at most at "render_fps"
+            frames per second, instead of in updateGUI (see publish).
+        """
+        self.map = MAP.getCachedMap()
+        # Static map layer, converted to color only once
+        self.map_layer = cv2.cvtColor(self.map, cv2.COLOR_GRAY2RGB)
         self.particles = []
         self.laser = []
         self.resetGUI()
         self.robot = robot
         if self.robot is None:
             self.robot = HAL()
+        self.particle_view = particle_view
+        self.headless = headless
+        self.render_every = render_every
+        self.update_count = 0
+        self.window_open = False
+        self.video_writer = None
+        if video_file is not None:
+            map_height, map_width = self.map.shape
+            self.video_writer = VideoWriterThread(video_file, (map_width, map_height))
+        self.mailbox = Mailbox()
+        self.render_thread = None
+        if render_thread:
+            self.render_thread = RenderThread(self, render_fps)
 
     def getRobotPose(self):
         return self.robot.pose
@@ -25,7 +167,7 @@ class GUI:
         """ Reset the GUI image.
             Remove all particles and other lines and keep only the empty map
         """
-        self.gui_map = cv2.cvtColor(self.map, cv2.COLOR_GRAY2RGB)
+        self.gui_map = self.map_layer.copy()
     
     def getImage(self):
         """ Returns the color image that is shown in the GUI.
@@ -44,30 +186,85 @@ class GUI:
             - Particles
             Set "block" arg as True to block the simulation until a key is pressed.
             It is possible to enable/disable some drawing items with the corresponging show_* args
+            The GUI is only drawn in one of every "render_every" updates,
+            but the robot is updated in all of them.
+            With a render thread, the GUI elements are only published (see publish)
+            and "block" is ignored, so the simulation never waits for the drawing.
+        """
+        if self.render_thread is not None:
+            self.publish(show_particles, show_laser)
+            self.robot.step()
+            return
+
+        render = self.update_count % self.render_every == 0
+        self.update_count += 1
+
+        if render:
+            self.drawFrame(self.robot.pose, self.particles if show_particles else [],
+                           self.laser if show_laser else [])
+
+        # Advance the clock one simulation step and
+        # update the robot's pose after drawing
+        self.robot.step()
+
+        if not render:
+            return
+
+        if block:
+            wait_time = 0
+        self.showFrame(wait_time)
+
+    def publish(self, show_particles=True, show_laser=True):
+        """ Publish a snapshot of the robot pose, particles and laser data
+            for the render thread. Only the latest snapshot is drawn.
         """
+        particles = np.array(self.particles) if show_particles else []
+        laser = np.array(self.laser) if show_laser else []
+        self.mailbox.put((np.array(self.robot.pose), particles, laser))
+
+    def drawFrame(self, pose, particles, laser):
+        """ Draw a new frame with the map, the particles, the laser and the robot in pose """
         # Reset the map canvas
         self.resetGUI()
 
         # Add the list of particles (if any)
-        if show_particles and len(self.particles) > 0:
-           self.drawParticles()
+        if len(particles) > 0:
+            if self.particle_view == "heatmap":
+                self.drawParticleHeatmap(particles=particles)
+            else:
+                self.drawParticles(particles=particles)
 
         # Add laser readings
-        if show_laser and len(self.laser) > 0:
-            self.drawLaser()
+        if len(laser) > 0:
+            self.drawLaser(laser=laser)
 
         # Draw the robot's pose
-        self.drawRobot(self.robot.pose)
+        self.drawRobot(pose)
 
-        # Update the robot's pose after drawing
-        self.robot.updatePose()
+    def showFrame(self, wait_time=1):
+        """ Record the current frame and show it in the window (unless headless) """
+        if self.video_writer is not None:
+            self.video_writer.write(self.gui_map)
 
-        cv2.imshow(WINDOW_NAME, self.gui_map)
+        if self.headless:
+            return
 
-        if block:
-            wait_time = 0
+        cv2.imshow(WINDOW_NAME, self.gui_map)
+        self.window_open = True
         cv2.waitKey(wait_time)
 
+    def close(self):
+        """ Stop the render thread (if any), close the video file (if any) and the GUI window """
+        if self.render_thread is not None:
+            self.render_thread.close()
+            self.render_thread = None
+        if self.video_writer is not None:
+            self.video_writer.close()
+            self.video_writer = None
+        if self.window_open:
+            cv2.destroyWindow(WINDOW_NAME)
+            self.window_open = False
+
     def drawRobot(self, pose, arrow_length=10, thickness=2, color=(0,0,255)):
         """ Draw the robot in the map.
             It is possible to change the color and size of the arrow marker.
@@ -88,13 +285,63 @@ class GUI:
         """
         self.particles = particles
 
-    def drawParticles(self, color=(255,0,0), arrow_length=10, thickness=1):
-        """ Draw the particles in the map.
+    def drawParticles(self, color=(255,0,0), arrow_length=10, thickness=1, particles=None):
+        """ Draw the particles in the map (the shown ones by default).
             Particles are expected in world coordinates (x, y, yaw) (m, m, rad).
             It is possible to change the color and size of the arrow markers.
         """
-        for p_world in self.particles:
-            self.drawRobot(p_world, arrow_length=arrow_length, thickness=thickness, color=(255,0,0))
+        if particles is None:
+            particles = self.particles
+        if len(particles) == 0:
+            return
+        # Convert all the particles to map coordinates at once
+        map_poses = MAP.worldToMapArray(np.asarray(particles)[:, :3])
+        # Draw all the arrows with a single polyline call
+        cv2.polylines(self.gui_map, arrowPolylines(map_poses, arrow_length), isClosed=False,
+                      color=color, thickness=thickness)
+
+    def drawParticleHeatmap(self, cell_size=HEATMAP_CELL_SIZE, alpha=HEATMAP_ALPHA,
+                            show_heading=True, arrow_length=6, color=(255,255,255), particles=None):
+        """ Draw the density of the particles (the shown ones by default) in the map as a heatmap.
+            Particles are binned in cells of cell_size x cell_size map cells and
+            the colormap of the counts is blended over the occupied cells.
+            With show_heading, an arrow shows the mean heading of each occupied cell.
+        """
+        map_height, map_width = self.gui_map.shape[:2]
+        grid_height = -(-map_height // cell_size)
+        grid_width = -(-map_width // cell_size)
+        if particles is None:
+            particles = self.particles
+        if len(particles) == 0:
+            return
+        # Bin all the particles in the grid at once (2D histogram)
+        map_poses = MAP.worldToMapArray(np.asarray(particles)[:, :3])
+        cell_x = np.clip(map_poses[:, 0].astype(int) // cell_size, 0, grid_width - 1)
+        cell_y = np.clip(map_poses[:, 1].astype(int) // cell_size, 0, grid_height - 1)
+        cells = cell_y * grid_width + cell_x
+        grid_size = grid_height * grid_width
+        counts = np.bincount(cells, minlength=grid_size).reshape(grid_height, grid_width)
+
+        # Colormap of the (log) density, scaled up to the map size
+        density = np.log1p(counts) / np.log1p(counts.max())
+        heatmap = cv2.applyColorMap((255 * density).astype(np.uint8), HEATMAP_COLORMAP)
+        heatmap = np.repeat(np.repeat(heatmap, cell_size, axis=0), cell_size, axis=1)[:map_height, :map_width]
+        occupied = np.repeat(np.repeat(counts > 0, cell_size, axis=0), cell_size, axis=1)[:map_height, :map_width]
+        blended = cv2.addWeighted(heatmap, alpha, self.gui_map, 1 - alpha, 0)
+        self.gui_map[occupied] = blended[occupied]
+
+        if not show_heading:
+            return
+        # Mean heading of each occupied cell, drawn from the cell center
+        sin_sum = np.bincount(cells, weights=np.sin(map_poses[:, 2]), minlength=grid_size)
+        cos_sum = np.bincount(cells, weights=np.cos(map_poses[:, 2]), minlength=grid_size)
+        occupied_cells = np.flatnonzero(counts.ravel())
+        centers_x = (occupied_cells % grid_width) * cell_size + cell_size // 2
+        centers_y = (occupied_cells // grid_width) * cell_size + cell_size // 2
+        headings = np.arctan2(sin_sum[occupied_cells], cos_sum[occupied_cells])
+        cell_poses = np.column_stack((centers_x, centers_y, headings))
+        cv2.polylines(self.gui_map, arrowPolylines(cell_poses, arrow_length), isClosed=False,
+                      color=color, thickness=1)
 
     def showLaser(self, laser):
         """ Store and prepare the laser data to be drawn in the next update.
@@ -102,15 +349,22 @@ class GUI:
         """
         self.laser = laser
 
-    def drawLaser(self, color=(0,0,255), point_size=2):
-        """ Draw the laser end points in the map.
+    def drawLaser(self, color=(0,0,255), point_size=2, laser=None):
+        """ Draw the laser end points in the map (the shown laser data by default).
             Laser data is expected to be in world coordinates (x, y, yaw) (m, m, rad).
             It is possible to change the color and size of the arrow markers.
         """
-        # Convert laser from world to map coordinates
-        laser_cells = MAP.worldToMapArray(self.laser)
-        # Iterate and draw a circle marker at each endpoint
-        for laser_point in laser_cells:
-            laser_point = int(laser_point[0]), int(laser_point[1])
-            cv2.circle(self.gui_map, laser_point, radius=point_size, thickness=cv2.FILLED, color=color)
+        if laser is None:
+            laser = self.laser
+        # Convert laser from world to map coordinates (ignoring beams without hit)
+        laser_cells = MAP.worldToMapArray(laser)
+        laser_cells = laser_cells[np.all(np.isfinite(laser_cells[:, :2]), axis=1), :2].astype(int)
+        # Stamp a filled disk marker at all the endpoints at once
+        offset_y, offset_x = np.mgrid[-point_size:point_size + 1, -point_size:point_size + 1]
+        disk = offset_x ** 2 + offset_y ** 2 <= point_size ** 2
+        pixels_x = (laser_cells[:, 0:1] + offset_x[disk]).ravel()
+        pixels_y = (laser_cells[:, 1:2] + offset_y[disk]).ravel()
+        map_height, map_width = self.gui_map.shape[:2]
+        inside = (pixels_x >= 0) & (pixels_x < map_width) & (pixels_y >= 0) & (pixels_y < map_height)
+        self.gui_map[pixels_y[inside], pixels_x[inside]] = color
 
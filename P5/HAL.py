@@ -1,4 +1,5 @@
 import time
+from collections import OrderedDict
 import numpy as np
 
 import MAP
@@ -7,18 +8,122 @@ import MAP
 MAX_LASER_DISTANCE = 100
 
 # Value of obstacle cells in the occupancy grid map
-OBSTACLE_VALUE = 0
+OBSTACLE_VALUE = MAP.OBSTACLE_VALUE
+
+# Number of laser beams (one per degree)
+N_LASER_BEAMS = 180
+
+# Precomputed range lookup table (see build_range_table.py)
+RANGE_TABLE_FILE = "range_table_grannyannie.npy"
+# Number of discretized headings of the table (one per degree)
+RANGE_TABLE_HEADINGS = 360
+# Stored ranges are in 1/RANGE_TABLE_RESOLUTION map cells
+RANGE_TABLE_RESOLUTION = 16
+# Stored value of the beams that do not hit any obstacle
+RANGE_TABLE_NO_HIT = np.iinfo(np.uint16).max
+
+# Margin (in cells) subtracted from the clearance when sphere tracing.
+# It covers the truncation of the DDA cells (up to sqrt(2) cells) and rounding errors
+SPHERE_TRACING_MARGIN = 1.5
+
+# Scan cache (see HAL.useScanCache): max number of cached scans and
+# size of the heading bins (degrees) of the quantized poses
+SCAN_CACHE_SIZE = 20000
+SCAN_CACHE_HEADING_BIN = 1.0
+
+def laserBeamIndices(beams=None):
+    """ Returns the indices (angles in degrees) of the laser beams to cast.
+        "beams" can be None (all the beams), an int stride (every n-th beam)
+        or a sequence of beam indices in the [0, 180) range.
+    """
+    if beams is None:
+        return np.arange(N_LASER_BEAMS)
+    if isinstance(beams, (int, np.integer)):
+        return np.arange(0, N_LASER_BEAMS, beams)
+    return np.asarray(beams, dtype=int)
+
+def loadRangeTable(table_file=RANGE_TABLE_FILE):
+    """ Open the precomputed range table as a read-only memory map.
+        The table has one row per free cell of the map (in row-major order)
+        and one column per discretized heading.
+    """
+    return np.load(table_file, mmap_mode='r')
+
+class WallClock:
+    """ Clock that follows the real (wall-clock) time """
+    def time(self):
+        """ Returns the current time in seconds """
+        return time.time()
+
+    def tick(self):
+        """ Simulation step. Nothing to do: the real time advances by itself """
+        pass
+
+class SimulatedClock:
+    """ Clock with a simulated time that only advances a fixed step on each tick.
+        Simulations run as fast as the CPU allows and are exactly reproducible.
+    """
+    def __init__(self, step=0.1, start_time=0.0):
+        self.step = step
+        self.start_time = start_time
+        self.ticks = 0
+
+    def time(self):
+        """ Returns the current simulated time in seconds """
+        return self.start_time + self.ticks * self.step
+
+    def tick(self):
+        """ Simulation step. Advance the simulated time one step """
+        self.ticks += 1
 
 class HAL:
     """ Hardware Abstraction Layer.
         This class provides funcitons to move the robot (setV/setW) and to read the laser sensor.
     """
-    def __init__(self, initial_pos=MAP.ROBOT_START_POSITION):
+    def __init__(self, initial_pos=MAP.ROBOT_START_POSITION, clock=None):
+        """ Create the robot in initial_pos.
+            The clock (WallClock by default) gives the time used to update the pose.
+        """
         self.pose = initial_pos.copy()
-        self.map_array = MAP.getMap()
+        self.map_array = MAP.getCachedMap()
         self.linear_vel = 0.0
         self.angular_vel = 0.0
-        self.last_update_time = time.time()
+        self.clock = clock if clock is not None else WallClock()
+        self.last_update_time = self.clock.time()
+        self.range_table = None
+        self.range_table_index = None
+        # Map pyramid level used to cast the beams (see useMapLevel)
+        self.map_level = 0
+        self.map_cell_size = 1
+        # Clearance map used to sphere trace the beams (see useSphereTracing)
+        self.clearance_map = None
+        # LRU cache of the scans of quantized poses (see useScanCache)
+        self.scan_cache = None
+        self.scan_cache_size = 0
+        self.scan_cache_heading_bin = 0.0
+        self.scan_cache_hits = 0
+        self.scan_cache_misses = 0
+
+    def __getstate__(self):
+        """ Do not pickle the map when the HAL is sent to other processes """
+        state = self.__dict__.copy()
+        del state['map_array']
+        state['clearance_map'] = self.clearance_map is not None
+        if self.scan_cache is not None:
+            # The cached scans are not sent, only the cache settings
+            state['scan_cache'] = OrderedDict()
+        return state
+
+    def __setstate__(self, state):
+        """ Use the process' cached map when the HAL is unpickled """
+        sphere_tracing = state.pop('clearance_map')
+        self.__dict__.update(state)
+        self.map_array = MAP.getCachedMap()
+        self.clearance_map = None
+        if self.map_level > 0:
+            self.useMapLevel(self.map_level)
+        if sphere_tracing:
+            self.useSphereTracing()
 
     def getPose(self):
         """ Returns the 2D pose as a tuple (x, y, yaw) """
@@ -49,16 +154,227 @@ class HAL:
 
         return (np.inf, np.inf)
 
-    def getLaserData(self):
+    def virtual_laser_beams(self, start_x, start_y, end_x, end_y):
+        """ Vectorized version of virtual_laser_beam.
+            All the beams are marched together, one DDA step per iteration,
+            until an obstacle is found or their end point is reached.
+            Start/end points are 1D arrays (one value per beam).
+            Returns an (N, 2) array with the cells where each beam ends.
+            Beams that reach their end point (or leave the map) are set to infinite.
+        """
+        start_x = np.asarray(start_x, dtype=int)
+        start_y = np.asarray(start_y, dtype=int)
+        # Number of steps of each beam (dx or dy depending on what is bigger)
+        steps = np.maximum(np.abs(end_x - start_x).astype(int),
+                           np.abs(end_y - start_y).astype(int))
+        # Small step values of each beam
+        dx = (end_x - start_x) / steps
+        dy = (end_y - start_y) / steps
+
+        laser_xy = np.full((steps.shape[0], 2), np.inf)
+        map_height, map_width = self.map_array.shape
+        # Indices of the beams that are still being marched
+        active = np.arange(steps.shape[0])
+        i = 0
+        while active.size > 0:
+            # Stop the beams that reached their end point
+            active = active[i < steps[active]]
+            # Compute the cell of each active beam for this step
+            x = start_x[active] + (dx[active] * i).astype(int)
+            y = start_y[active] + (dy[active] * i).astype(int)
+            # Stop the beams that leave the map without finding an obstacle
+            inside = (x >= 0) & (x < map_width) & (y >= 0) & (y < map_height)
+            active, x, y = active[inside], x[inside], y[inside]
+            # Store the beams that hit an obstacle and stop marching them
+            hit = self.map_array[y, x] == OBSTACLE_VALUE
+            laser_xy[active[hit], 0] = x[hit]
+            laser_xy[active[hit], 1] = y[hit]
+            active = active[~hit]
+            i += 1
+
+        return laser_xy
+
+    def sphere_trace_laser_beams(self, start_x, start_y, end_x, end_y):
+        """ Sphere tracing version of virtual_laser_beams.
+            The beams visit the same cells as the DDA, but each one jumps ahead
+            all the steps that stay within the clearance of its current cell,
+            which are known to be free. Open areas are crossed in a few jumps
+            and the end points are the same as with the DDA.
+            Returns an (N, 2) array with the cells where each beam ends.
+            Beams that reach their end point (or leave the map) are set to infinite.
+        """
+        start_x = np.asarray(start_x, dtype=int)
+        start_y = np.asarray(start_y, dtype=int)
+        # Number of steps of each beam (dx or dy depending on what is bigger)
+        steps = np.maximum(np.abs(end_x - start_x).astype(int),
+                           np.abs(end_y - start_y).astype(int))
+        # Small step values of each beam and their length (in cells)
+        dx = (end_x - start_x) / steps
+        dy = (end_y - start_y) / steps
+        step_length = np.hypot(dx, dy)
+
+        laser_xy = np.full((steps.shape[0], 2), np.inf)
+        map_height, map_width = self.map_array.shape
+        # Indices of the beams that are still being marched and their current step
+        active = np.arange(steps.shape[0])
+        i = np.zeros(steps.shape[0], dtype=int)
+        while active.size > 0:
+            # Stop the beams that reached their end point
+            active = active[i[active] < steps[active]]
+            step = i[active]
+            # Compute the cell of each active beam for its current step
+            x = start_x[active] + (dx[active] * step).astype(int)
+            y = start_y[active] + (dy[active] * step).astype(int)
+            # Stop the beams that leave the map without finding an obstacle
+            inside = (x >= 0) & (x < map_width) & (y >= 0) & (y < map_height)
+            active, step, x, y = active[inside], step[inside], x[inside], y[inside]
+            # Store the beams that hit an obstacle and stop marching them
+            hit = self.map_array[y, x] == OBSTACLE_VALUE
+            laser_xy[active[hit], 0] = x[hit]
+            laser_xy[active[hit], 1] = y[hit]
+            miss = ~hit
+            active, step, x, y = active[miss], step[miss], x[miss], y[miss]
+            # Jump ahead the steps whose cells are closer than the clearance (at least one)
+            clearance = self.clearance_map[y, x] - SPHERE_TRACING_MARGIN
+            jump = np.floor(clearance / step_length[active]).astype(int) + 1
+            i[active] = step + np.maximum(jump, 1)
+
+        return laser_xy
+
+    def useSphereTracing(self, enabled=True):
+        """ Cast the beams by sphere tracing through the clearance map of the map
+            in use (see MAP.getClearanceMap) instead of visiting every cell.
+            Set enabled to False to go back to the DDA.
+        """
+        if not enabled:
+            self.clearance_map = None
+        elif self.map_level == 0:
+            self.clearance_map = MAP.getClearanceMap()
+        else:
+            self.clearance_map = MAP.getClearanceMap(self.map_array)
+
+    def useMapLevel(self, level):
+        """ Cast the beams on a level of the map pyramid (see MAP.getMapPyramid).
+            Level 0 is the full resolution map and each level halves the resolution,
+            so beams are faster but less accurate.
+            Only getLaserDataBatch supports coarse levels.
+        """
+        self.map_array = MAP.getMapPyramid(level + 1, MAP.getCachedMap())[level]
+        self.map_level = level
+        self.map_cell_size = 2 ** level
+        if self.clearance_map is not None:
+            self.useSphereTracing()
+        self.clearScanCache()
+        if level > 0:
+            # The range table is only valid at full resolution
+            self.useRangeTable(None)
+
+    def useRangeTable(self, range_table):
+        """ Use a precomputed range table (see loadRangeTable) to get the laser
+            measurements instead of casting the beams on the map.
+            Set it to None to go back to ray casting.
+        """
+        self.clearScanCache()
+        if range_table is None:
+            self.range_table = None
+            self.range_table_index = None
+            return
+        free_cells = self.map_array != OBSTACLE_VALUE
+        if range_table.shape != (np.count_nonzero(free_cells), RANGE_TABLE_HEADINGS):
+            raise ValueError(F"Range table shape {range_table.shape} does not match the map")
+        # Row of the table for each map cell (-1 for obstacle cells)
+        self.range_table_index = np.full(self.map_array.shape, -1, dtype=np.int32)
+        self.range_table_index[free_cells] = np.arange(range_table.shape[0])
+        self.range_table = range_table
+
+    def useScanCache(self, size=SCAN_CACHE_SIZE, heading_bin=SCAN_CACHE_HEADING_BIN):
+        """ Cache the scans of getLaserDataBatch in a bounded LRU cache.
+            Poses are quantized to the cells of the map in use and to heading bins
+            of heading_bin degrees, and all the poses with the same cell and bin
+            share the scan cast from the center of the bin.
+            Keeps up to "size" scans (set it to 0 or None to disable the cache).
+        """
+        if not size:
+            self.scan_cache = None
+            return
+        self.scan_cache = OrderedDict()
+        self.scan_cache_size = size
+        self.scan_cache_heading_bin = np.radians(heading_bin)
+        self.scan_cache_hits = 0
+        self.scan_cache_misses = 0
+
+    def clearScanCache(self):
+        """ Forget the cached scans (e.g. when the map in use changes) """
+        if self.scan_cache is not None:
+            self.scan_cache.clear()
+
+    def getScanCacheStats(self):
+        """ Returns the hits, misses and size (number of cached scans) of the scan cache """
+        return {
+            "hits": self.scan_cache_hits,
+            "misses": self.scan_cache_misses,
+            "size": len(self.scan_cache) if self.scan_cache is not None else 0,
+        }
+
+    def lookup_laser_beams(self, start_x, start_y, angles):
+        """ Table version of virtual_laser_beams.
+            Looks up the range of each beam in the range table instead of marching it.
+            Start points and angles (in map coordinates) are 1D arrays (one value per beam).
+            Angles are rounded to the nearest whole-degree heading of the table, which moves
+            the end points a few cells (and much more at grazing angles, see USE_RANGE_TABLE
+            in MonteCarloLaserLocalization.py).
+            Returns an (N, 2) array with the cells where each beam ends.
+            Beams that do not hit any obstacle are set to infinite.
+        """
+        map_height, map_width = self.map_array.shape
+        start_x = np.clip(start_x, 0, map_width - 1)
+        start_y = np.clip(start_y, 0, map_height - 1)
+        table_rows = self.range_table_index[start_y, start_x]
+        heading_bins = np.rint(np.degrees(angles)).astype(int) % RANGE_TABLE_HEADINGS
+        # Beams starting in an obstacle end where they start
+        ranges = np.zeros(start_x.shape[0])
+        free = table_rows >= 0
+        ranges[free] = self.range_table[table_rows[free], heading_bins[free]]
+        no_hit = ranges == RANGE_TABLE_NO_HIT
+        ranges[no_hit] = 0
+        ranges /= RANGE_TABLE_RESOLUTION
+
+        laser_xy = np.empty((start_x.shape[0], 2))
+        laser_xy[:, 0] = start_x + (ranges * np.cos(angles)).astype(int)
+        laser_xy[:, 1] = start_y + (ranges * np.sin(angles)).astype(int)
+        laser_xy[no_hit] = np.inf
+        return laser_xy
+
+    def getLaserData(self, beams=None):
         """ Returns the measurements from the laser sensor.
             Returns a list of (x,y) points in global world coordinates.
+            Use "beams" to cast only a subset of the beams (see laserBeamIndices).
         """
+        beam_indices = laserBeamIndices(beams)
         # Get the robot pose in map coordinates as the origin of the laser 
         start_x, start_y, robot_yaw_map = MAP.worldToMap(*self.pose)
         # Convert max laser detection distance from meters to map cells
         laser_distance_cells = MAX_LASER_DISTANCE * MAP.MAP_SCALE
+        if self.range_table is not None:
+            # Look up all the beams in the precomputed range table
+            n_beams = beam_indices.shape[0]
+            angles = robot_yaw_map + np.radians(beam_indices) - np.pi/2
+            laser_xy = self.lookup_laser_beams(np.full(n_beams, start_x),
+                                               np.full(n_beams, start_y), angles)
+            virtual_laser_xy = np.column_stack((laser_xy, np.zeros(n_beams)))
+            return MAP.mapToWorldArray(virtual_laser_xy)
+        if self.clearance_map is not None:
+            # Sphere trace all the beams together
+            n_beams = beam_indices.shape[0]
+            angles = robot_yaw_map + np.radians(beam_indices) - np.pi/2
+            laser_xy = self.sphere_trace_laser_beams(
+                np.full(n_beams, start_x), np.full(n_beams, start_y),
+                start_x + laser_distance_cells * np.cos(angles),
+                start_y + laser_distance_cells * np.sin(angles))
+            virtual_laser_xy = np.column_stack((laser_xy, np.zeros(n_beams)))
+            return MAP.mapToWorldArray(virtual_laser_xy)
         virtual_laser_xy = []
-        for beam_angle in range(180):
+        for beam_angle in beam_indices:
             # Actual beam's angle in map coordinates
             # Substract 90º to have the center aligned with the robot
             angle = robot_yaw_map + np.radians(beam_angle) - np.pi/2
@@ -71,6 +387,97 @@ class HAL:
         world_laser_xy = MAP.mapToWorldArray(np.array(virtual_laser_xy))
         return world_laser_xy
 
+    def getLaserDataBatch(self, poses, beams=None):
+        """ Returns the laser measurements for several poses at once.
+            Poses is an (N, 3) array of (x, y, yaw) in world coordinates.
+            Returns an (N, B, 2) array of (x,y) points in global world coordinates,
+            where B is the number of beams selected with "beams" (180 by default).
+            With the scan cache (see useScanCache), scans of quantized poses are reused.
+        """
+        beam_indices = laserBeamIndices(beams)
+        poses = np.asarray(poses, dtype=float).reshape(-1, 3)
+        # Get the poses in map coordinates as the origins of the lasers
+        # (in cells of the map pyramid level in use)
+        map_poses = MAP.worldToMapArray(poses)
+        start_x = (map_poses[:, 0] / self.map_cell_size).astype(int)
+        start_y = (map_poses[:, 1] / self.map_cell_size).astype(int)
+        if self.scan_cache is not None:
+            return self.cached_laser_scans(start_x, start_y, map_poses[:, 2], beam_indices)
+        return self.cast_laser_scans(start_x, start_y, map_poses[:, 2], beam_indices)
+
+    def cast_laser_scans(self, start_x, start_y, yaw, beam_indices):
+        """ Cast the beams of several poses given in map coordinates:
+            start cells (of the map level in use) and yaw of each pose.
+            Returns an (N, B, 2) array of (x,y) points in global world coordinates.
+        """
+        n_beams = beam_indices.shape[0]
+        n_poses = start_x.shape[0]
+        # Convert max laser detection distance from meters to map cells
+        laser_distance_cells = MAX_LASER_DISTANCE * MAP.MAP_SCALE / self.map_cell_size
+        # Actual beams' angles in map coordinates (one row per pose)
+        # Substract 90º to have the center aligned with the robot
+        beam_angles = np.radians(beam_indices)
+        angles = yaw[:, np.newaxis] + beam_angles - np.pi/2
+        # Compute the theoretical (max) endpoints of the lasers
+        end_x = start_x[:, np.newaxis] + laser_distance_cells * np.cos(angles)
+        end_y = start_y[:, np.newaxis] + laser_distance_cells * np.sin(angles)
+        # Get the laser measurements of all the beams together
+        if self.range_table is not None:
+            virtual_laser_xy = self.lookup_laser_beams(
+                np.repeat(start_x, n_beams), np.repeat(start_y, n_beams),
+                angles.ravel())
+        elif self.clearance_map is not None:
+            virtual_laser_xy = self.sphere_trace_laser_beams(
+                np.repeat(start_x, n_beams), np.repeat(start_y, n_beams),
+                end_x.ravel(), end_y.ravel())
+        else:
+            virtual_laser_xy = self.virtual_laser_beams(
+                np.repeat(start_x, n_beams), np.repeat(start_y, n_beams),
+                end_x.ravel(), end_y.ravel())
+        # Convert the end points (centers of the cells of the level) from map to world coordinates
+        virtual_laser_xy = virtual_laser_xy * self.map_cell_size + (self.map_cell_size - 1) / 2
+        scale = np.array([-MAP.MAP_SCALE, MAP.MAP_SCALE])
+        world_laser_xy = (virtual_laser_xy - MAP.MAP_OFFSET) / scale
+        return world_laser_xy.reshape(n_poses, n_beams, 2)
+
+    def cached_laser_scans(self, start_x, start_y, yaw, beam_indices):
+        """ Cached version of cast_laser_scans.
+            Only the quantized poses that are not in the scan cache are cast
+            (once, even if several poses share them) and added to the cache,
+            dropping the least recently used scans when it is full.
+        """
+        heading_bin = self.scan_cache_heading_bin
+        heading_bins = np.floor(np.mod(yaw, 2*np.pi) / heading_bin).astype(int)
+        beams_key = beam_indices.tobytes()
+        scans = np.empty((start_x.shape[0], beam_indices.shape[0], 2))
+        # Poses of each quantized pose missing in the cache
+        missing = {}
+        for index, key in enumerate(zip(start_x.tolist(), start_y.tolist(), heading_bins.tolist())):
+            key = key + (beams_key,)
+            scan = self.scan_cache.get(key)
+            if scan is None:
+                missing.setdefault(key, []).append(index)
+            else:
+                self.scan_cache.move_to_end(key)
+                scans[index] = scan
+        self.scan_cache_misses += len(missing)
+        self.scan_cache_hits += start_x.shape[0] - len(missing)
+        if not missing:
+            return scans
+
+        # Cast the missing scans from the centers of their heading bins
+        keys = list(missing)
+        cells = np.array([key[:3] for key in keys])
+        new_scans = self.cast_laser_scans(cells[:, 0], cells[:, 1], (cells[:, 2] + 0.5) * heading_bin,
+                                          beam_indices)
+        for key, scan in zip(keys, new_scans):
+            scans[missing[key]] = scan
+            # Copy the scan, so the cache does not keep the whole batch alive
+            self.scan_cache[key] = scan.copy()
+        while len(self.scan_cache) > self.scan_cache_size:
+            self.scan_cache.popitem(last=False)
+        return scans
+
     def setV(self, linear_vel):
         """ Sets the linear velocity """
         self.linear_vel = linear_vel
@@ -82,7 +489,7 @@ class HAL:
     def updatePose(self):
         """ Update the pose of the robot after dt seconds """
         # Get the time diference since the last update
-        update_time = time.time()
+        update_time = self.clock.time()
         dt = update_time - self.last_update_time
         # Update robot position according to the set velocities
         self.pose[0] += dt * self.linear_vel * np.cos(self.pose[2])
@@ -90,3 +497,8 @@ class HAL:
         self.pose[2] += dt * self.angular_vel
 
         self.last_update_time = update_time
+
+    def step(self):
+        """ Simulation step: advance the clock one step and update the pose """
+        self.clock.tick()
+        self.updatePose()
@@ -20,6 +20,10 @@
     Several global variables are available with info related to map size, scale and limits
 """
 
+import glob
+import hashlib
+import os
+import zipfile
 import cv2
 import numpy as np
 
@@ -55,12 +59,191 @@ MAP_OFFSET = (200, 260) # Resized image
 WORLD_LIMITS_LOW = (-4.975, -6.5)
 WORLD_LIMITS_HIGH = (5.0, 3.475)
 
+# Value of obstacle cells in the occupancy grid map
+OBSTACLE_VALUE = 0
+
+# Radius (meters) of the inflated obstacles layer (see getInflatedMap)
+INFLATION_RADIUS = 0.2
+
+# Version of the derived map layers. Increase it when they are computed differently
+MAP_LAYERS_VERSION = 2
+
+# Derived map layers shared by all the users of the process (see getMapLayer)
+cached_layers = {}
+# On-disk cache of the derived map layers (see mapLayersFile)
+cached_layers_file = None
+
 def getMap():
     """ Read the map image as a grayscale numpy array """
     map_img = cv2.imread(MAP_FILE, cv2.IMREAD_GRAYSCALE)
     map_img = cv2.resize(map_img, dsize=(MAP_WIDTH, MAP_HEIGHT), interpolation=cv2.INTER_NEAREST)
     return map_img
 
+def mapLayersFile():
+    """ Path of the on-disk cache of the derived map layers.
+        It is keyed by the hash of the map image and the parameters used to derive the layers,
+        so it is rebuilt whenever any of them changes.
+    """
+    global cached_layers_file
+    if cached_layers_file is None:
+        with open(MAP_FILE, 'rb') as map_file:
+            key = hashlib.sha1(map_file.read())
+        key.update(repr((MAP_WIDTH, MAP_HEIGHT, cv2.INTER_NEAREST, MAP_SCALE,
+                         INFLATION_RADIUS, MAP_LAYERS_VERSION)).encode())
+        cached_layers_file = F"{os.path.splitext(MAP_FILE)[0]}.{key.hexdigest()[:16]}.layers.npz"
+    return cached_layers_file
+
+def computeMapLayers():
+    """ Compute all the derived map layers:
+        - map: the resized grayscale map
+        - free_cells: (M, 2) array with the (x, y) map coordinates of the free cells
+        - distance: distance (in meters) from each cell to the nearest obstacle
+        - inflated: map with the obstacles inflated by INFLATION_RADIUS
+        - clearance: distance (in cells) from each cell to the nearest obstacle or the map border
+    """
+    map_array = getMap()
+    free_y, free_x = np.nonzero(map_array != OBSTACLE_VALUE)
+    inflation_cells = int(np.ceil(INFLATION_RADIUS * MAP_SCALE))
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (2 * inflation_cells + 1, 2 * inflation_cells + 1))
+    return {
+        "map": map_array,
+        "free_cells": np.column_stack((free_x, free_y)),
+        "distance": getDistanceMap(map_array),
+        # Obstacles are 0, so eroding the free space inflates them
+        "inflated": cv2.erode(map_array, kernel),
+        "clearance": getClearanceMap(map_array),
+    }
+
+def saveMapLayers(layers_file, layers):
+    """ Save the map layers in layers_file (written atomically) and remove the caches
+        of older versions of the map or the layers. Returns False if they could not be saved
+        (e.g. read-only directory): the layers are then only kept in memory.
+    """
+    tmp_file = F"{layers_file}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_file, 'wb') as output_file:
+            np.savez(output_file, **layers)
+        os.replace(tmp_file, layers_file)
+    except OSError:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        return False
+    for old_file in glob.glob(F"{glob.escape(os.path.splitext(MAP_FILE)[0])}.*.layers.npz"):
+        if os.path.abspath(old_file) != os.path.abspath(layers_file):
+            try:
+                os.remove(old_file)
+            except OSError:
+                pass
+    return True
+
+def getMapLayer(name):
+    """ Returns a derived map layer (see computeMapLayers) as a read-only numpy array.
+        Layers are loaded lazily on first access and shared by all the callers of the process.
+        They are read from the on-disk cache (see mapLayersFile), which is built on the first run.
+    """
+    if name not in cached_layers:
+        layers_file = mapLayersFile()
+        try:
+            with np.load(layers_file) as layers:
+                layer = layers[name]
+        except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+            # Missing or invalid cache: compute all the layers, keep them and save them
+            layers = computeMapLayers()
+            saveMapLayers(layers_file, layers)
+            for layer_name, layer in layers.items():
+                layer.flags.writeable = False
+                cached_layers.setdefault(layer_name, layer)
+            return cached_layers[name]
+        layer.flags.writeable = False
+        cached_layers[name] = layer
+    return cached_layers[name]
+
+def getCachedMap():
+    """ Returns the map as a read-only grayscale numpy array.
+        The map is loaded only once per process and the same array is shared
+        by all the callers. Forked processes inherit it instead of loading it again.
+    """
+    return getMapLayer("map")
+
+def getFreeCells():
+    """ Returns an (M, 2) array with the (x, y) map coordinates of all the free
+        cells of the cached map. The index is loaded only once per process.
+    """
+    return getMapLayer("free_cells")
+
+def getInflatedMap():
+    """ Returns the map with the obstacles inflated by INFLATION_RADIUS (read-only) """
+    return getMapLayer("inflated")
+
+def sampleFreePoses(n_poses, rng=None):
+    """ Draw random poses in free space, in world coordinates (x, y, yaw).
+        Positions are uniform over the free cells of the map and yaws uniform in [0, 2*pi).
+        rng is the numpy.random.Generator to use (a new one by default).
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    free_cells = getFreeCells()
+    cells = free_cells[rng.integers(free_cells.shape[0], size=n_poses)]
+    map_poses = np.empty((n_poses, 3))
+    # Uniform position inside each selected cell
+    map_poses[:, :2] = cells + rng.uniform(0.0, 1.0, size=(n_poses, 2))
+    map_poses[:, 2] = rng.uniform(0.0, 2*np.pi, size=n_poses)
+    return mapToWorldArray(map_poses)
+
+def isFreeArray(world_coords):
+    """ Returns a boolean array telling which of the world coordinates (x, y, ...)
+        are in free cells of the cached map (cells outside the map are not free).
+    """
+    map_array = getCachedMap()
+    map_x = np.floor(-MAP_SCALE * world_coords[:, 0] + MAP_OFFSET[0]).astype(int)
+    map_y = np.floor(MAP_SCALE * world_coords[:, 1] + MAP_OFFSET[1]).astype(int)
+    inside = (map_x >= 0) & (map_x < MAP_WIDTH) & (map_y >= 0) & (map_y < MAP_HEIGHT)
+    free = np.zeros(world_coords.shape[0], dtype=bool)
+    free[inside] = map_array[map_y[inside], map_x[inside]] != OBSTACLE_VALUE
+    return free
+
+def getDistanceMap(map_array=None):
+    """ Compute the Euclidean distance field of the map.
+        Each cell stores the distance (in meters) to the nearest obstacle cell.
+        Without map_array, returns the cached (read-only) layer of the map.
+    """
+    if map_array is None:
+        return getMapLayer("distance")
+    # Obstacle cells are 0, so they are the zero pixels of the distance transform
+    distance_cells = cv2.distanceTransform(map_array, cv2.DIST_L2, cv2.DIST_MASK_PRECISE)
+    return distance_cells / MAP_SCALE
+
+def getClearanceMap(map_array=None):
+    """ Compute the clearance of each cell: the distance (in cells) to the nearest
+        obstacle cell or to the outside of the map, whichever is closer.
+        Without map_array, returns the cached (read-only) layer of the map.
+    """
+    if map_array is None:
+        return getMapLayer("clearance")
+    # Surround the map with a frame of obstacles, so the outside counts as an obstacle
+    framed = cv2.copyMakeBorder(map_array, 1, 1, 1, 1, cv2.BORDER_CONSTANT, value=OBSTACLE_VALUE)
+    clearance = cv2.distanceTransform(framed, cv2.DIST_L2, cv2.DIST_MASK_PRECISE)
+    return clearance[1:-1, 1:-1]
+
+def getMapPyramid(levels=4, map_array=None):
+    """ Build a pyramid of downsampled occupancy grids.
+        Level 0 is the map itself and each level halves the resolution of the previous one.
+        A coarse cell is an obstacle if any of its children is an obstacle
+        (the map is padded with free cells when its size is not divisible).
+        Returns the list of levels.
+    """
+    if map_array is None:
+        map_array = getCachedMap()
+    pyramid = [map_array]
+    for _ in range(1, levels):
+        fine = pyramid[-1]
+        height, width = fine.shape
+        padded = np.pad(fine, ((0, height % 2), (0, width % 2)), constant_values=fine.max())
+        # Obstacles are 0, so the min of each 2x2 block keeps them
+        coarse = padded.reshape(padded.shape[0] // 2, 2, padded.shape[1] // 2, 2).min(axis=(1, 3))
+        pyramid.append(coarse)
+    return pyramid
+
 def mapToWorld(mx, my, myaw=0.0):
     """ Convert map coordinates (pixels) to real world coordinates (meters) """
     wx = - (mx - MAP_OFFSET[0]) / MAP_SCALE
@@ -1,244 +1,799 @@
+import os
 import time
+import signal
+import cProfile
 import numpy as np
 from GUI import GUI
-from HAL import HAL
+from HAL import HAL, WallClock, SimulatedClock, loadRangeTable, laserBeamIndices, N_LASER_BEAMS
 import MAP
+from profiling import StageProfiler, StageRecorder, PROFILE_WINDOW
 import multiprocessing as mp
+from multiprocessing import shared_memory
 
 # Maximum laser detection distance in meters
 MAX_LASER_DISTANCE = 100
 
-# Number of particles
-N_PARTICLES = 120
-N_GROUPS = 12
-PARTICLES_PER_GROUP = N_PARTICLES // N_GROUPS
+# Bounds of the number of particles, adapted with KLD-sampling
+MIN_PARTICLES = 100
+MAX_PARTICLES = 2000
+# Initial number of particles (global localization needs the most)
+N_PARTICLES = MAX_PARTICLES
+
+# KLD-sampling: max error (epsilon) between the sampled and the true belief,
+# upper quantile (z) of the standard normal for the 1 - delta confidence (0.99)
+# and size of the histogram bins (x, y, yaw) used to measure the belief spread
+KLD_EPSILON = 0.05
+KLD_Z = 2.326
+KLD_BIN_SIZE = np.array([0.5, 0.5, np.radians(20)])
+
+# Number of particle evaluation workers (one per core)
+N_WORKERS = mp.cpu_count()
+
+# Sensor model used to weight the particles: "raycast" or "likelihood_field"
+SENSOR_MODEL = "raycast"
+
+# Likelihood field model: standard deviation (meters) of the Gaussian noise of the
+# end points and mixture weights of the hits and of the random measurements
+LIKELIHOOD_FIELD_SIGMA = 0.2
+LIKELIHOOD_FIELD_Z_HIT = 0.9
+LIKELIHOOD_FIELD_Z_RAND = 0.1
+
+# Use the precomputed range table (build_range_table.py) instead of ray casting.
+# The table stores whole-degree headings and each beam uses the nearest one. Against the
+# ray cast on 500 random free poses (180 beams), the end points of the beams that hit are
+# a median of 1 cell apart, 5 cells at p99 and up to ~300 cells at grazing angles
+USE_RANGE_TABLE = False
+
+# Cast the full resolution beams (robot and particles) by sphere tracing through the
+# clearance map instead of visiting every cell. Same end points, faster in open areas
+USE_SPHERE_TRACING = True
+
+# Reuse the scans of particles with the same quantized pose (map cell and heading bin
+# of SCAN_CACHE_HEADING_BIN degrees) in an LRU cache of up to SCAN_CACHE_SIZE scans
+# per worker and map level (0 to disable it). The resampled particles are jittered,
+# so few of them share a quantized pose and the cache is disabled by default
+SCAN_CACHE_SIZE = 0
+SCAN_CACHE_HEADING_BIN = 1.0
+
+# Only every n-th laser beam is compared between the robot and the particles
+LASER_SAMPLING_STEP = 15
+
+# Coarse-to-fine scoring for global localization (ray cast model only):
+# the particles are scored first on these coarse levels of the map pyramid and
+# only the best COARSE_SURVIVAL_FRACTION of each level is scored on the next one,
+# ending at full resolution. Used while there are at least COARSE_MIN_PARTICLES
+# particles (the robot is not localized yet). Empty list to disable it.
+COARSE_LEVELS = [3]
+COARSE_SURVIVAL_FRACTION = 0.1
+COARSE_MIN_PARTICLES = 1000
+
+# Cascaded scoring (ray cast model only): the particles are scored first with
+# CASCADE_BEAMS[0] well-spread beams of the sampled ones, and those whose partial
+# log-likelihood is more than CASCADE_MARGIN below the best one are discarded.
+# Each next stage adds beams up to CASCADE_BEAMS[i] for the survivors, ending
+# with all the sampled beams. It pays off while the particles are spread (global
+# localization) but not once they gather around the robot, so it is disabled by default.
+# Empty list to disable it.
+CASCADE_BEAMS = []
+CASCADE_MARGIN = 1.0
+
+# Error (in meters) of a beam that hits an obstacle in only one of the compared scans
+NO_HIT_BEAM_ERROR = 10.0
+
+# GUI settings: no window (e.g. on servers), draw one of every N frames,
+# optional video file where the drawn frames are recorded and how the
+# particles are drawn ("arrows" or "heatmap", better for many particles)
+GUI_HEADLESS = False
+GUI_RENDER_EVERY = 1
+GUI_VIDEO_FILE = None
+GUI_PARTICLE_VIEW = "arrows"
+# Draw the GUI in its own thread at up to GUI_RENDER_FPS frames per second,
+# so the filter never waits for the drawing (GUI_RENDER_EVERY is then ignored)
+GUI_RENDER_THREAD = False
+GUI_RENDER_FPS = 30
 
 # Constant robot velocities
 LINEAR_VEL = 0.5
 ANGULAR_VEL = 0.8
 
+# Standard deviation of the motion noise (x, y, yaw)
+MOTION_NOISE_STD = np.array([0.02, 0.02, 0.01])
+
+# Resample when the effective sample size drops below this fraction of the particles
+RESAMPLE_ESS_FRACTION = 0.5
+# Standard deviation of the noise added to the resampled particles (x, y, yaw)
+RESAMPLE_NOISE_STD = np.array([0.05, 0.05, 0.01])
+
+# Stage profiling of the filter loop (see profiling.py): time each stage,
+# print the summary every PROFILE_PRINT_EVERY iterations (0 for only on exit)
+# and optional JSON file where the summary is dumped on exit
+PROFILE_STAGES = False
+PROFILE_PRINT_EVERY = 100
+PROFILE_FILE = None
+# Worker group profiled with cProfile (None to disable; SIGUSR1 toggles group 0 at runtime).
+# The stats of each worker are dumped to PROFILE_WORKER_FILE.<pid>
+PROFILE_WORKER_GROUP = None
+PROFILE_WORKER_FILE = "mcl_worker.prof"
+
+# Settings read by the workers. They are sent to them (see worker_settings), so changes
+# made after importing the module also reach workers that re-import it (spawn start method)
+WORKER_SETTINGS = ("SENSOR_MODEL", "LIKELIHOOD_FIELD_SIGMA", "LIKELIHOOD_FIELD_Z_HIT", "LIKELIHOOD_FIELD_Z_RAND",
+                   "USE_RANGE_TABLE", "USE_SPHERE_TRACING", "SCAN_CACHE_SIZE", "SCAN_CACHE_HEADING_BIN",
+                   "LASER_SAMPLING_STEP", "COARSE_LEVELS", "COARSE_SURVIVAL_FRACTION", "CASCADE_BEAMS",
+                   "CASCADE_MARGIN", "NO_HIT_BEAM_ERROR", "PROFILE_STAGES", "PROFILE_WORKER_FILE")
+
+# Random generator of the particle filter
+rng = np.random.default_rng()
+
+# Simulated time step (seconds) of each filter iteration.
+# None to follow the real time instead
+SIM_TIME_STEP = None
+# Seed of the random numbers of the filter, to reproduce a run exactly (None for a random one)
+RANDOM_SEED = None
+
+# Clock shared by the robot, the GUI and the motion model (see main)
+clock = WallClock()
+
 # Time of the last propagation of the particles
-last_update_time = time.time()
+last_update_time = clock.time()
 
 # Max laser distance (map scale)
 laser_distance_cells = MAX_LASER_DISTANCE * MAP.MAP_SCALE
 
-# highest probability particle
-max_prob = 0
-best_particle = np.array([0, 0, 0])
-
-class Particle:
-    def __init__(self, x_cor, y_cor, robot_yaw, prob):
-        self.xcoord = x_cor
-        self.ycoord = y_cor
-        self.yaw = robot_yaw
-        self.probability = prob
+# Per-process state of the particle evaluation workers (see init_worker)
+worker_hal = None
+worker_coarse_hals = {}
+distance_map = None
+worker_profiler = StageRecorder(enabled=False)
+# Particles scored by each stage of the cascade and survivors (see cascaded_log_likelihoods)
+worker_cascade_counts = None
+worker_cprofile = None
+
+# Scan cache and cascade counters of each worker, by process id (see update_particle_weights)
+worker_stats = {}
+
+# Shared memory arrays exchanged with the workers (see create_shared_arrays)
+shared_blocks = {}
+shared_arrays = {}
+
+class ParticleSet:
+    """ Set of particles stored as contiguous arrays (struct of arrays).
+        The x/y/yaw and weight buffers are allocated once with a fixed capacity
+        and only the first "size" particles are in use.
+        The x/y/yaw buffer can be given (e.g. allocated in shared memory).
+    """
+    def __init__(self, capacity=MAX_PARTICLES, pose_buffer=None):
+        if pose_buffer is None:
+            pose_buffer = np.zeros((3, capacity))
+        self.capacity = capacity
+        self.size = 0
+        self.pose_buffer = pose_buffer
+        self.x, self.y, self.yaw = pose_buffer
+        self.weight = np.zeros(capacity)
+
+    @property
+    def poses(self):
+        """ (N, 3) view of the (x, y, yaw) of the particles in use """
+        return self.pose_buffer[:, :self.size].T
+
+    @property
+    def weights(self):
+        """ View of the weights of the particles in use """
+        return self.weight[:self.size]
+
+    def setPoses(self, poses):
+        """ Copy an (N, 3) array of poses into the set, with uniform weights """
+        if len(poses) > self.capacity:
+            raise ValueError(F"{len(poses)} particles exceed the capacity of the set ({self.capacity})")
+        self.size = len(poses)
+        self.pose_buffer[:, :self.size] = np.transpose(poses)
+        self.weights[:] = 1 / self.size
+
+    def propagate(self, dt):
+        """ Propagate the pose of all the particles dt seconds (in place) """
+        update_particles_pose(self.poses, dt)
+
+    def updateLogWeights(self, log_likelihoods):
+        """ Multiply the weights by the measurement likelihoods, given as logarithms.
+            The product is normalized with log-sum-exp, so it does not underflow.
+        """
+        with np.errstate(divide='ignore'):
+            log_weights = np.log(self.weights) + log_likelihoods
+        log_total = log_sum_exp(log_weights)
+        if not np.isfinite(log_total):
+            # No particle explains the measurement: start again with uniform weights
+            self.weights[:] = 1 / self.size
+            return
+        self.weight[:self.size] = np.exp(log_weights - log_total)
+
+    def effectiveSampleSize(self):
+        """ Effective sample size of the (normalized) weights """
+        return effective_sample_size(self.weights)
+
+    def estimatePose(self):
+        """ Returns the weighted mean pose (x, y, yaw) of the particles """
+        weights = self.weights / np.sum(self.weights)
+        x = np.dot(weights, self.x[:self.size])
+        y = np.dot(weights, self.y[:self.size])
+        yaw = np.arctan2(np.dot(weights, np.sin(self.yaw[:self.size])),
+                         np.dot(weights, np.cos(self.yaw[:self.size])))
+        return np.array([x, y, np.mod(yaw, 2 * np.pi)])
+
+    def resample(self):
+        """ Resample the particles according to their weights (in place).
+            The number of particles is adapted with KLD-sampling.
+        """
+        self.setPoses(resample_particles(self.poses, self.weights))
 
 def initialize_particles():
     """ Generate random particles in world coordinates (meters).
-        X/Y values are constrained within the map limits.
+        X/Y values are drawn only from the free cells of the map.
         Yaw values are in the [0, 2*pi] range.
     """
-    particles = np.zeros((N_PARTICLES, 4))
-    x_low, y_low = MAP.WORLD_LIMITS_LOW
-    x_high, y_high = MAP.WORLD_LIMITS_HIGH
-    particles = np.random.uniform(low=[x_low, y_low, 0.0],
-                                  high=[x_high, y_high, 2*np.pi],
-                                  size=(particles.shape[0], 3))
-    return particles
+    return MAP.sampleFreePoses(N_PARTICLES, rng)
 
-def update_particle_pose(particle, dt):
-    """ Update the pose of a particle in the dt period.
+def update_particles_pose(particles, dt):
+    """ Update the pose of all the particles in the dt period (in place).
         Add a random Gaussian noise to the movement.
     """
-    yaw = particle[2]
+    yaw = particles[:, 2]
     # Estimate robot movement in dt according to the set velocities
     dx = dt * LINEAR_VEL * np.cos(yaw)
     dy = dt * LINEAR_VEL * np.sin(yaw)
     dyaw = dt * ANGULAR_VEL
-    # Add this movement to the particle, with an extra Gaussian noise
-    particle[0] += dx + np.random.normal(0.0, 0.02)
-    particle[1] += dy + np.random.normal(0.0, 0.02)
-    particle[2] += dyaw + np.random.normal(0.0, 0.01)
+    # Draw the Gaussian noise of all the particles at once
+    noise = rng.normal(0.0, MOTION_NOISE_STD, size=(particles.shape[0], 3))
+    # Add this movement to the particles, with the extra Gaussian noise
+    particles[:, 0] += dx + noise[:, 0]
+    particles[:, 1] += dy + noise[:, 1]
+    particles[:, 2] += dyaw + noise[:, 2]
 
     x_low, y_low = MAP.WORLD_LIMITS_LOW
     x_high, y_high = MAP.WORLD_LIMITS_HIGH
-    particle[0] = np.clip(particle[0], x_low, x_high)
-    particle[1] = np.clip(particle[1], y_low, y_high)
+    np.clip(particles[:, 0], x_low, x_high, out=particles[:, 0])
+    np.clip(particles[:, 1], y_low, y_high, out=particles[:, 1])
 
-def propagate_particles(particles):
+def propagate_particles(particle_set):
     """ Estimate the movement of the robot since the last update
         and propagate the pose of all particles according to this movement.
     """
     global last_update_time
     # Get the time diference since the last update
-    current_time = time.time()
+    current_time = clock.time()
     dt = current_time - last_update_time
     # Update all particles according to dt
-    for p in particles:
-        update_particle_pose(p, dt)
+    particle_set.propagate(dt)
     # Reset the update time
     last_update_time = current_time
-    return particles
-
-
-def calculate_similarity(real_data, virtual_data):
-    """ Calculate the similarity between the real and virtual laser data.
-        Convert both data to NumPy arrays and ensure they are the same size.
-    """
-    # Convert to NumPy arrays and ensure they are the same size
-    real_data = np.array(real_data)
-    virtual_data = np.array(virtual_data)
-    
-    # Use the minimum size to avoid out-of-range indices
-    min_len = min(len(real_data), len(virtual_data))
-    real_data = real_data[:min_len]
-    virtual_data = virtual_data[:min_len]
-    
-    # Sample every 15 data points
-    real_sampled = real_data[::15, :2]
-    virtual_sampled = virtual_data[::15, :2]
-    
-    # Calculate distances and similarity
-    distances = np.linalg.norm(real_sampled - virtual_sampled, axis=1)
-    similarity = np.sum(np.exp(-distances))
-    
-    return similarity
-
-
-def process_group(group_particles, robot):
-    """ Process a group of particles and calculate their similarity
-        to the robot's laser data. Return the group probabilities, 
-        the highest probability, and the best particle.
-    """
-    hal_object = HAL()
-    local_max_prob = 0
-    local_best_particle = None
-    group_probabilities = []
-
-    # Copy the latest robot laser data
-    robot_laser_data = robot.getLaserData().copy()
-
-    for particle in group_particles:
-        # Set the particle's pose in the HAL object
-        hal_object.pose = particle
-        # Get the laser data for the particle's pose
-        particle_world_laser_data = hal_object.getLaserData()
-        
-        # Calculate the similarity between the robot's and the particle's laser data
-        similarity = calculate_similarity(robot_laser_data, particle_world_laser_data)
-        group_probabilities.append(similarity)
-
-        # Update the local best particle if this one has higher similarity
-        if similarity > local_max_prob:
-            local_max_prob = similarity
-            local_best_particle = particle
-
-    return group_probabilities, local_max_prob, local_best_particle
-
-
-def generate_new_particles(best_particles, num_particles_to_generate):
-    """ Generate new particles around the best particles using a 
-        multivariate normal distribution with reduced covariance.
-    """
-    new_particles = []
-    for best_particle in best_particles:
-        # Use x, y coordinates of the best particle
-        mean = best_particle[:2]
-        # Reduced covariance for less dispersion
-        covariance_matrix = np.array([[0.05, 0], [0, 0.05]])
-        new_positions = np.random.multivariate_normal(mean, 
-                            covariance_matrix, num_particles_to_generate)
-        
-        for position in new_positions:
-            # Reduced angle noise
-            new_angle = best_particle[2] + np.random.normal(0.0, 0.01)
-            # Ensure the angle is in the range [0, 2*pi]
-            new_angle = np.mod(new_angle, 2 * np.pi)
-            new_particle = np.array([position[0], position[1], new_angle])
-            new_particles.append(new_particle)
-    
+    return particle_set
+
+
+def world_laser_to_robot(laser_data, pose):
+    """ Transform laser end points from world coordinates to the
+        robot frame given by pose (x, y, yaw).
+    """
+    cos_yaw, sin_yaw = np.cos(pose[2]), np.sin(pose[2])
+    rel_x = laser_data[:, 0] - pose[0]
+    rel_y = laser_data[:, 1] - pose[1]
+    local_x = cos_yaw * rel_x + sin_yaw * rel_y
+    local_y = -sin_yaw * rel_x + cos_yaw * rel_y
+    return np.column_stack((local_x, local_y))
+
+
+def log_sum_exp(values, axis=None):
+    """ Compute log(sum(exp(values))) without overflow/underflow """
+    max_value = np.max(values, axis=axis, keepdims=True)
+    max_value[~np.isfinite(max_value)] = 0.0
+    total = np.sum(np.exp(values - max_value), axis=axis, keepdims=True)
+    with np.errstate(divide='ignore'):
+        result = np.log(total) + max_value
+    return np.squeeze(result, axis=axis) if axis is not None else result.item()
+
+
+def score_particles(real_data, virtual_data):
+    """ Compute the log-likelihood of a batch of particles in one pass.
+        real_data is the (B, 2) reference scan and virtual_data the (N, B, 2)
+        virtual scans of the particles (world coordinates).
+        The log-likelihood of each particle is log(sum(exp(-distance))) over the beams.
+        Beams without hit (infinite) match when both scans miss, and count as
+        NO_HIT_BEAM_ERROR meters when only one of them misses.
+        Returns N log-likelihoods.
+    """
+    real_hit = np.all(np.isfinite(real_data), axis=-1)
+    virtual_hit = np.all(np.isfinite(virtual_data), axis=-1)
+    with np.errstate(invalid='ignore'):
+        distances = np.linalg.norm(virtual_data - real_data, axis=-1)
+    distances = np.where(real_hit & virtual_hit, distances,
+                         np.where(real_hit == virtual_hit, 0.0, NO_HIT_BEAM_ERROR))
+    return log_sum_exp(-distances, axis=1)
+
+
+def likelihood_field_similarity(robot_local_laser, particles, distance_map):
+    """ Calculate the similarity of a group of particles with the likelihood field model.
+        The laser end points (in robot frame) are projected from each particle's pose
+        and scored with the distance d to the nearest obstacle of the map.
+        Each beam has log p = log(z_hit * exp(-d^2 / (2 * sigma^2)) + z_rand)
+        and the log-likelihood of a particle is the sum over the beams.
+        Returns one log-likelihood per particle (0 for all if no beam hits).
+    """
+    # Ignore the beams that did not hit any obstacle
+    robot_local_laser = robot_local_laser[np.all(np.isfinite(robot_local_laser), axis=1)]
+    if robot_local_laser.shape[0] == 0:
+        return np.zeros(particles.shape[0])
+    # Project the end points into each particle's frame: (N, beams)
+    cos_yaw = np.cos(particles[:, 2:3])
+    sin_yaw = np.sin(particles[:, 2:3])
+    world_x = particles[:, 0:1] + cos_yaw * robot_local_laser[:, 0] - sin_yaw * robot_local_laser[:, 1]
+    world_y = particles[:, 1:2] + sin_yaw * robot_local_laser[:, 0] + cos_yaw * robot_local_laser[:, 1]
+    # Convert to map cells
+    map_x = (-MAP.MAP_SCALE * world_x + MAP.MAP_OFFSET[0]).astype(int)
+    map_y = (MAP.MAP_SCALE * world_y + MAP.MAP_OFFSET[1]).astype(int)
+    # End points out of the map get the max distance of the field
+    inside = (map_x >= 0) & (map_x < MAP.MAP_WIDTH) & (map_y >= 0) & (map_y < MAP.MAP_HEIGHT)
+    distances = np.full(map_x.shape, distance_map.max())
+    distances[inside] = distance_map[map_y[inside], map_x[inside]]
+    # Gaussian hit term mixed with random measurements, one per beam
+    beam_log_likelihoods = np.logaddexp(
+        np.log(LIKELIHOOD_FIELD_Z_HIT) - distances ** 2 / (2 * LIKELIHOOD_FIELD_SIGMA ** 2),
+        np.log(LIKELIHOOD_FIELD_Z_RAND))
+    return np.sum(beam_log_likelihoods, axis=1)
+
+
+def shared_array_shapes(capacity):
+    """ Shapes of the arrays shared with the workers:
+        - particles: x/y/yaw rows of the particles (see ParticleSet), in world coordinates
+        - log_likelihoods: log-likelihood of each particle, written by the workers
+        - robot_pose / robot_laser: pose and full scan of the real robot
+    """
+    return {
+        "particles": (3, capacity),
+        "log_likelihoods": (capacity,),
+        "robot_pose": (3,),
+        "robot_laser": (N_LASER_BEAMS, 2),
+    }
+
+
+def create_shared_arrays(capacity=MAX_PARTICLES):
+    """ Allocate the shared memory blocks exchanged with the workers.
+        Returns the names of the blocks, to be attached by init_worker.
+        The blocks must be released with release_shared_arrays.
+    """
+    for key, shape in shared_array_shapes(capacity).items():
+        block = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)) * 8)
+        shared_blocks[key] = block
+        shared_arrays[key] = np.ndarray(shape, dtype=np.float64, buffer=block.buf)
+    return {key: block.name for key, block in shared_blocks.items()}
+
+
+def attach_shared_arrays(block_names, capacity=MAX_PARTICLES):
+    """ Attach the shared memory blocks created by create_shared_arrays """
+    for key, shape in shared_array_shapes(capacity).items():
+        block = shared_memory.SharedMemory(name=block_names[key])
+        shared_blocks[key] = block
+        shared_arrays[key] = np.ndarray(shape, dtype=np.float64, buffer=block.buf)
+
+
+def release_shared_arrays(unlink=True):
+    """ Close the shared memory blocks and remove them (if unlink) """
+    shared_arrays.clear()
+    for block in shared_blocks.values():
+        block.close()
+        if unlink:
+            block.unlink()
+    shared_blocks.clear()
+
+
+def worker_settings():
+    """ Returns the current value of the WORKER_SETTINGS (see init_worker) """
+    return {name: globals()[name] for name in WORKER_SETTINGS}
+
+
+def init_worker(block_names, capacity=MAX_PARTICLES, settings=None):
+    """ Initialize a particle evaluation worker.
+        The map and the sensor model are loaded once per process
+        and reused by all the groups processed by the worker.
+        Particles, robot scan and log-likelihoods are read/written in shared memory.
+        The settings of the main process (see worker_settings) override the worker's.
+    """
+    global worker_hal, worker_coarse_hals, distance_map, worker_profiler, worker_cascade_counts
+    if settings is not None:
+        globals().update(settings)
+    # Let the main process handle Ctrl+C and shut down the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    attach_shared_arrays(block_names, capacity)
+    worker_profiler = StageRecorder(enabled=PROFILE_STAGES)
+    worker_cascade_counts = np.zeros((len(cascade_beam_sets()) - 1, 2), dtype=int)
+    worker_hal = HAL()
+    if USE_RANGE_TABLE:
+        # The table is shared by all the workers through the page cache
+        worker_hal.useRangeTable(loadRangeTable())
+    elif USE_SPHERE_TRACING:
+        worker_hal.useSphereTracing()
+    # One HAL per coarse level of the map pyramid
+    worker_coarse_hals = {}
+    for level in COARSE_LEVELS:
+        worker_coarse_hals[level] = HAL()
+        worker_coarse_hals[level].useMapLevel(level)
+    if SCAN_CACHE_SIZE:
+        for hal_object in [worker_hal] + list(worker_coarse_hals.values()):
+            hal_object.useScanCache(SCAN_CACHE_SIZE, SCAN_CACHE_HEADING_BIN)
+    if SENSOR_MODEL == "likelihood_field":
+        distance_map = MAP.getDistanceMap()
+
+
+def raycast_log_likelihoods(hal_object, particles, robot_laser_data):
+    """ Log-likelihoods of the particles with the ray cast model,
+        casting the sampled beams on the map of hal_object.
+    """
+    # Get only the sampled beams of all the particles' poses
+    robot_laser_data = robot_laser_data[::LASER_SAMPLING_STEP]
+    with worker_profiler.stage("raycast"):
+        particles_laser_data = hal_object.getLaserDataBatch(particles, beams=LASER_SAMPLING_STEP)
+    # Score all the particles' laser data against the robot's at once
+    with worker_profiler.stage("similarity"):
+        return score_particles(robot_laser_data, particles_laser_data)
+
+
+def cascade_beam_sets():
+    """ Beams of each stage of the cascade: evenly spaced subsets of the sampled beams
+        (from the first to the last one) of CASCADE_BEAMS beams, ending with all of them.
+        Each set also contains the beams of the previous ones (nested sets), and the
+        counts that do not add beams to the previous set (or add all of them) are skipped.
+    """
+    sampled_beams = laserBeamIndices(LASER_SAMPLING_STEP)
+    beam_sets = []
+    beams = np.empty(0, dtype=int)
+    for n_beams in CASCADE_BEAMS:
+        if n_beams <= 0:
+            continue
+        spread = np.linspace(0, sampled_beams.shape[0] - 1, n_beams)
+        stage_beams = np.union1d(beams, sampled_beams[np.rint(spread).astype(int)])
+        if beams.shape[0] < stage_beams.shape[0] < sampled_beams.shape[0]:
+            beams = stage_beams
+            beam_sets.append(beams)
+    beam_sets.append(sampled_beams)
+    return beam_sets
+
+
+def cascaded_log_likelihoods(hal_object, particles, robot_laser_data):
+    """ Log-likelihoods of the particles with the ray cast model, scored in cascade.
+        Each stage casts only the beams of its set (see cascade_beam_sets) that were not
+        cast yet, for the particles that survived the previous stages, and accumulates them
+        in their log-likelihood. The particles more than CASCADE_MARGIN below the best one
+        are discarded (-inf log-likelihood) and the survivors get the full sampled scan.
+    """
+    partial_log_likelihoods = np.full(particles.shape[0], -np.inf)
+    survivors = np.arange(particles.shape[0])
+    cast_beams = np.empty(0, dtype=int)
+    beam_sets = cascade_beam_sets()
+    for stage, beams in enumerate(beam_sets):
+        new_beams = np.setdiff1d(beams, cast_beams)
+        cast_beams = np.union1d(cast_beams, new_beams)
+        if new_beams.shape[0] > 0:
+            with worker_profiler.stage("raycast"):
+                particles_laser_data = hal_object.getLaserDataBatch(particles[survivors], beams=new_beams)
+            with worker_profiler.stage("similarity"):
+                new_log_likelihoods = score_particles(robot_laser_data[new_beams], particles_laser_data)
+            # log(sum(exp())) of all the beams cast so far
+            partial_log_likelihoods[survivors] = np.logaddexp(partial_log_likelihoods[survivors],
+                                                              new_log_likelihoods)
+        if stage == len(beam_sets) - 1:
+            break
+        scores = partial_log_likelihoods[survivors]
+        keep = scores >= scores.max() - CASCADE_MARGIN
+        worker_cascade_counts[stage] += (survivors.shape[0], np.count_nonzero(keep))
+        partial_log_likelihoods[survivors[~keep]] = -np.inf
+        survivors = survivors[keep]
+    return partial_log_likelihoods
+
+
+def coarse_to_fine_log_likelihoods(particles, robot_laser_data):
+    """ Log-likelihoods of the particles scored from coarse to fine map levels.
+        Each coarse level keeps only the best COARSE_SURVIVAL_FRACTION of the particles,
+        and the survivors of the last one are scored at full resolution.
+        Discarded particles get a -inf log-likelihood.
+    """
+    log_likelihoods = np.full(particles.shape[0], -np.inf)
+    survivors = np.arange(particles.shape[0])
+    for level in COARSE_LEVELS:
+        coarse_log_likelihoods = raycast_log_likelihoods(worker_coarse_hals[level], particles[survivors],
+                                                         robot_laser_data)
+        n_survivors = int(np.ceil(COARSE_SURVIVAL_FRACTION * survivors.shape[0]))
+        best = np.argpartition(-coarse_log_likelihoods, n_survivors - 1)[:n_survivors]
+        survivors = survivors[best]
+    log_likelihoods[survivors] = fine_log_likelihoods(particles[survivors], robot_laser_data)
+    return log_likelihoods
+
+
+def fine_log_likelihoods(particles, robot_laser_data):
+    """ Log-likelihoods of the particles with the ray cast model at full resolution,
+        in cascade if CASCADE_BEAMS is set
+    """
+    if len(CASCADE_BEAMS) > 0:
+        return cascaded_log_likelihoods(worker_hal, particles, robot_laser_data)
+    return raycast_log_likelihoods(worker_hal, particles, robot_laser_data)
+
+
+def process_group(start, stop, coarse_to_fine=False, profile=False):
+    """ Process a group of particles and calculate their log-likelihood
+        given the robot's laser data. The group is the [start, stop) slice
+        of the shared particles and the log-likelihoods are written
+        in the same slice of the shared log_likelihoods.
+        Set coarse_to_fine to score the particles on the map pyramid first
+        and profile to run the group under cProfile (see PROFILE_WORKER_GROUP).
+        Returns the stage timings recorded by the worker and
+        the worker's process id and scan cache and cascade counters.
+    """
+    global worker_cprofile
+    if profile:
+        if worker_cprofile is None:
+            worker_cprofile = cProfile.Profile()
+        worker_cprofile.enable()
+
+    group_particles = shared_arrays["particles"][:, start:stop].T
+    robot_laser_data = shared_arrays["robot_laser"]
+
+    if SENSOR_MODEL == "likelihood_field":
+        # Score the robot's laser data directly against the distance field
+        with worker_profiler.stage("likelihood_field"):
+            robot_local_laser = world_laser_to_robot(robot_laser_data[::LASER_SAMPLING_STEP],
+                                                     shared_arrays["robot_pose"])
+            log_likelihoods = likelihood_field_similarity(robot_local_laser, group_particles, distance_map)
+    elif coarse_to_fine:
+        log_likelihoods = coarse_to_fine_log_likelihoods(group_particles, robot_laser_data)
+    else:
+        log_likelihoods = fine_log_likelihoods(group_particles, robot_laser_data)
+
+    shared_arrays["log_likelihoods"][start:stop] = log_likelihoods
+
+    if profile:
+        worker_cprofile.disable()
+        # Cumulative stats of all the profiled groups of this worker
+        worker_cprofile.dump_stats(F"{PROFILE_WORKER_FILE}.{os.getpid()}")
+    cache_stats = [hal_object.getScanCacheStats() for hal_object in [worker_hal] + list(worker_coarse_hals.values())]
+    cache_stats = {name: sum(stats[name] for stats in cache_stats) for name in cache_stats[0]}
+    return worker_profiler.takeRecords(), (os.getpid(), {"scan_cache": cache_stats,
+                                                         "cascade": worker_cascade_counts.tolist()})
+
+
+def effective_sample_size(weights):
+    """ Effective sample size (ESS) of a set of normalized weights.
+        It goes from 1 (all the weight in one particle) to N (uniform weights).
+    """
+    return 1.0 / np.sum(weights ** 2)
+
+
+def low_variance_resample(weights, n_samples=None):
+    """ Systematic (low-variance) resampling of a set of normalized weights.
+        A single random offset places n_samples evenly spaced pointers over
+        the cumulative weights. Returns the indices of the selected particles.
+    """
+    if n_samples is None:
+        n_samples = weights.shape[0]
+    positions = (rng.random() + np.arange(n_samples)) / n_samples
+    cumulative_weights = np.cumsum(weights)
+    indices = np.searchsorted(cumulative_weights, positions, side='right')
+    return np.minimum(indices, weights.shape[0] - 1)
+
+
+def kld_sample_size(n_bins, epsilon=KLD_EPSILON, z=KLD_Z):
+    """ KLD-sampling bound (Fox, 2003): number of particles needed so that
+        the KL divergence between the sampled and the true belief is below
+        epsilon with 1 - delta confidence, given the number of occupied bins
+        of the belief histogram. Works on arrays of bin counts.
+    """
+    k = np.maximum(n_bins - 1, 1)
+    a = 2 / (9 * k)
+    return np.ceil(k / (2 * epsilon) * (1 - a + np.sqrt(a) * z) ** 3)
+
+
+def kld_resample(particles, weights):
+    """ Resample the particles with an adaptive number of samples (KLD-sampling).
+        Samples are drawn until their number reaches the KLD bound of the
+        histogram bins they occupy, within [MIN_PARTICLES, MAX_PARTICLES].
+        Returns the selected particles.
+    """
+    # Draw the maximum number of samples, in random order
+    candidates = particles[low_variance_resample(weights, MAX_PARTICLES)]
+    candidates = candidates[rng.permutation(MAX_PARTICLES)]
+    # Number of occupied bins after each new sample
+    bins = np.floor(candidates / KLD_BIN_SIZE).astype(int)
+    bins[:, 2] = np.mod(bins[:, 2], int(np.ceil(2 * np.pi / KLD_BIN_SIZE[2])))
+    _, first_samples = np.unique(bins, axis=0, return_index=True)
+    new_bin = np.zeros(MAX_PARTICLES, dtype=bool)
+    new_bin[first_samples] = True
+    occupied_bins = np.cumsum(new_bin)
+    # Stop at the first sample count that reaches the bound of its bins
+    enough = np.flatnonzero(np.arange(1, MAX_PARTICLES + 1) >= kld_sample_size(occupied_bins))
+    n_samples = enough[0] + 1 if enough.size > 0 else MAX_PARTICLES
+    n_samples = np.clip(n_samples, MIN_PARTICLES, MAX_PARTICLES)
+    return candidates[:n_samples]
+
+
+def resample_particles(particles, weights):
+    """ Resample the particles according to their normalized weights.
+        The number of particles is adapted with KLD-sampling.
+        A small Gaussian noise is added to the copies to keep some diversity.
+    """
+    selected_particles = kld_resample(particles, weights)
+    new_particles = selected_particles + rng.normal(0.0, RESAMPLE_NOISE_STD, size=selected_particles.shape)
+    # Ensure the angle is in the range [0, 2*pi] and the position inside the map
+    new_particles[:, 2] = np.mod(new_particles[:, 2], 2 * np.pi)
+    x_low, y_low = MAP.WORLD_LIMITS_LOW
+    x_high, y_high = MAP.WORLD_LIMITS_HIGH
+    np.clip(new_particles[:, 0], x_low, x_high, out=new_particles[:, 0])
+    np.clip(new_particles[:, 1], y_low, y_high, out=new_particles[:, 1])
+    # Reject the noisy copies that fall inside obstacles: keep their original position
+    in_obstacle = ~MAP.isFreeArray(new_particles)
+    new_particles[in_obstacle, :2] = selected_particles[in_obstacle, :2]
     return new_particles
 
 
-# Create a HAL (robot) object
-robot = HAL()
-# Set a custom initial pose
-robot.pose[0] = 1.1
-# Create a GUI object and link it with the robot
-gui = GUI(robot=robot)
-
-# Initialize some random particles
-particles = initialize_particles()
-gui.showParticles(particles)
-gui.updateGUI()
-
-# Set a small velocity
-robot.setV(LINEAR_VEL)
-robot.setW(ANGULAR_VEL)
-
-# Store the time of the last pose update
-last_update_time = time.time()
-
-# counter and min_prob to let loop pass 2 laps to see initial particles
-counter = 0
-min_prob = 0.000000001
-
-while True:
-    # counter and min_prob to let loop pass 2 laps to see initial particles
-    if counter >= 3:
-        min_prob = 1 / N_PARTICLES
-
-    # Propagation (prediction) step
-    particles = propagate_particles(particles)
-    gui.showParticles(particles)
-
-    # Get some laser data and show it in the GUI
-    robot_laser_data = robot.getLaserData()
-    gui.showLaser(robot_laser_data)
-
-    # Split particles into groups (particles per thread)
-    particle_groups = [particles[i:i + PARTICLES_PER_GROUP] for i in range(0, N_PARTICLES, PARTICLES_PER_GROUP)]
-
-    # Create a pool of workers and process groups in parallel
-    with mp.Pool(processes=N_GROUPS) as pool:
-        results = pool.starmap(process_group, [(group, robot) for group in particle_groups])
-
-    # Collect results from all groups
-    particle_probabilities = []
-    for group_probabilities, local_max_prob, local_best_particle in results:
-        particle_probabilities.extend(group_probabilities)
-        if local_max_prob > max_prob:
-            max_prob = local_max_prob
-            best_particle = local_best_particle
-
-    # Normalize probabilities
-    total_probability = sum(particle_probabilities)
-    particle_probabilities = [p / total_probability for p in particle_probabilities]
-
-    new_particles = []
-    particles_to_delete = 0
-
-    for i in range(len(particle_probabilities)):
-        if particle_probabilities[i] < min_prob:
-            particles_to_delete += 1
-        else:
-            new_particles.append(particles[i])
-
-    # Consider the top N best particles for generating new particles 
-    # (4.5% of total particles)
-    top_n = int(N_PARTICLES * 0.045) 
-    sorted_indices = np.argsort(-np.array(particle_probabilities))
-    best_particles = particles[sorted_indices[:top_n]]
-
-    # Generate new particles
-    new_generated_particles = generate_new_particles(best_particles, particles_to_delete)
-    new_particles.extend(new_generated_particles)
-
-    particles = np.array(new_particles[:N_PARTICLES])
-
-    # Show the particles in the GUI
-    gui.showParticles(particles)
-    gui.updateGUI()
-    counter += 1
-    # time.sleep(0.1)
+def update_particle_weights(pool, particle_set, robot_laser_data, robot_pose, n_workers=N_WORKERS,
+                            profiler=None):
+    """ Measurement step: weight the particles with the robot's laser data.
+        The particles (already in shared memory) are split into one group per
+        worker and processed in parallel by the pool.
+        Many particles (global localization) are scored from coarse to fine.
+        The stage timings of the workers are added to profiler (if any).
+        Returns the log-likelihoods of the particles.
+    """
+    # Publish the robot data in shared memory (particles are already there)
+    n_particles = particle_set.size
+    shared_arrays["robot_pose"][:] = robot_pose
+    shared_arrays["robot_laser"][:] = robot_laser_data[:, :2]
+
+    coarse_to_fine = len(COARSE_LEVELS) > 0 and n_particles >= COARSE_MIN_PARTICLES
+
+    # Split particles into one group per worker and process them in parallel
+    bounds = np.linspace(0, n_particles, n_workers + 1).astype(int)
+    groups = [(start, stop, coarse_to_fine, group == PROFILE_WORKER_GROUP)
+              for group, (start, stop) in enumerate(zip(bounds[:-1], bounds[1:])) if stop > start]
+    for records, (worker_pid, stats) in pool.starmap(process_group, groups):
+        worker_stats[worker_pid] = stats
+        if profiler is not None:
+            profiler.recordAll(records)
+
+    # Collect the log-likelihoods of all groups and update the weights
+    log_likelihoods = shared_arrays["log_likelihoods"][:n_particles]
+    particle_set.updateLogWeights(log_likelihoods)
+    return log_likelihoods
+
+
+def resample_if_degenerate(particle_set):
+    """ Resample the particles only when the effective sample size drops
+        below RESAMPLE_ESS_FRACTION of the particles. Returns True if resampled.
+    """
+    if particle_set.effectiveSampleSize() < RESAMPLE_ESS_FRACTION * particle_set.size:
+        particle_set.resample()
+        return True
+    return False
+
+
+def toggle_worker_profiling(signum, frame):
+    """ Signal handler: start or stop profiling the first worker group with cProfile """
+    global PROFILE_WORKER_GROUP
+    PROFILE_WORKER_GROUP = 0 if PROFILE_WORKER_GROUP is None else None
+    print("Worker group profiling", "enabled" if PROFILE_WORKER_GROUP is not None else "disabled")
+
+
+def scan_cache_totals():
+    """ Hits, misses and hit rate of the scan caches of all the workers """
+    hits = sum(stats["scan_cache"]["hits"] for stats in worker_stats.values())
+    misses = sum(stats["scan_cache"]["misses"] for stats in worker_stats.values())
+    return {"hits": hits, "misses": misses, "hit_rate": hits / max(hits + misses, 1)}
+
+
+def cascade_survival_rates():
+    """ Fraction of the particles that survived each stage of the cascade, in all the workers """
+    counts = sum((np.array(stats["cascade"], dtype=int).reshape(-1, 2) for stats in worker_stats.values()),
+                 np.zeros((len(cascade_beam_sets()) - 1, 2), dtype=int))
+    return (counts[:, 1] / np.maximum(counts[:, 0], 1)).tolist()
+
+
+def report_profile(profiler):
+    """ Print the stage profiling summary and dump it to PROFILE_FILE (if any) """
+    if not profiler.enabled:
+        return
+    print(profiler.formatSummary())
+    if SCAN_CACHE_SIZE:
+        print("Scan cache:", scan_cache_totals())
+    if len(CASCADE_BEAMS) > 0:
+        print("Cascade survival rates:", cascade_survival_rates())
+    if PROFILE_FILE is not None:
+        profiler.dump(PROFILE_FILE)
+
+
+def main():
+    global clock, rng, last_update_time
+
+    # Use a fixed-step simulated clock or the real time
+    clock = SimulatedClock(SIM_TIME_STEP) if SIM_TIME_STEP is not None else WallClock()
+    if RANDOM_SEED is not None:
+        rng = np.random.default_rng(RANDOM_SEED)
+
+    # Time the stages of the loop (kill -USR1 <pid> to profile a worker group)
+    profiler = StageProfiler(PROFILE_WINDOW, enabled=PROFILE_STAGES)
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, toggle_worker_profiling)
+
+    # Create a HAL (robot) object
+    robot = HAL(clock=clock)
+    # Set a custom initial pose
+    robot.pose[0] = 1.1
+    if USE_SPHERE_TRACING:
+        robot.useSphereTracing()
+    # Create a GUI object and link it with the robot
+    gui = GUI(robot=robot, headless=GUI_HEADLESS, render_every=GUI_RENDER_EVERY,
+              video_file=GUI_VIDEO_FILE, particle_view=GUI_PARTICLE_VIEW,
+              render_thread=GUI_RENDER_THREAD, render_fps=GUI_RENDER_FPS)
+
+    # Allocate the shared memory blocks exchanged with the workers.
+    # They are released when leaving main (e.g. on Ctrl+C)
+    block_names = create_shared_arrays(MAX_PARTICLES)
+    try:
+        # Initialize some random particles, stored in shared memory
+        particle_set = ParticleSet(MAX_PARTICLES, pose_buffer=shared_arrays["particles"])
+        particle_set.setPoses(initialize_particles())
+        gui.showParticles(particle_set.poses)
+        gui.updateGUI()
+
+        # Set a small velocity
+        robot.setV(LINEAR_VEL)
+        robot.setW(ANGULAR_VEL)
+
+        # Store the time of the last pose update
+        last_update_time = clock.time()
+
+        # counter to let loop pass 2 laps to see initial particles
+        counter = 0
+
+        # Create a long-lived pool of workers, reused by all the iterations.
+        # The pool is terminated when leaving the with block
+        with profiler.stage("pool_startup"):
+            pool = mp.Pool(processes=N_WORKERS, initializer=init_worker,
+                           initargs=(block_names, MAX_PARTICLES, worker_settings()))
+        with pool:
+            while True:
+                iteration_start = time.perf_counter_ns()
+
+                # Propagation (prediction) step
+                with profiler.stage("propagate"):
+                    propagate_particles(particle_set)
+                gui.showParticles(particle_set.poses)
+
+                # Get some laser data and show it in the GUI
+                with profiler.stage("laser"):
+                    robot_laser_data = robot.getLaserData()
+                gui.showLaser(robot_laser_data)
+
+                # Measurement step: weight the particles in the worker pool
+                with profiler.stage("weights"):
+                    update_particle_weights(pool, particle_set, robot_laser_data, robot.getPose(),
+                                            profiler=profiler)
+
+                # Resample only when the effective sample size drops too much
+                # (let the loop pass 2 laps to see the initial particles)
+                if counter >= 3:
+                    with profiler.stage("resample"):
+                        resample_if_degenerate(particle_set)
+
+                # Show the particles in the GUI (only the drawing is timed)
+                gui.showParticles(particle_set.poses)
+                with profiler.stage("gui"):
+                    gui.updateGUI()
+                counter += 1
+                # time.sleep(0.1)
+
+                if profiler.enabled:
+                    profiler.record("iteration", time.perf_counter_ns() - iteration_start)
+                    if PROFILE_PRINT_EVERY > 0 and counter % PROFILE_PRINT_EVERY == 0:
+                        report_profile(profiler)
+    finally:
+        report_profile(profiler)
+        release_shared_arrays()
+        gui.close()
+
+
+if __name__ == '__main__':
+    main()
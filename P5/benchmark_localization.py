@@ -0,0 +1,209 @@
+""" Headless benchmark of the Monte Carlo localization.
+
+    Drives the HAL along scripted trajectories on mapgrannyannie.png without GUI
+    and runs the particle filter of MonteCarloLaserLocalization.py for each
+    configuration (number of particles, laser beam stride and number of workers).
+    Each run is seeded, so the same configuration always gets the same initial
+    particles and the same motion noise.
+
+    For each run it reports, as JSON:
+        - iterations_per_second: filter iterations per wall-clock second
+        - convergence_iteration / convergence_time: first iteration (and its
+          simulated time) where the estimated position stays within
+          CONVERGENCE_DISTANCE meters of HAL.pose for CONVERGENCE_ITERATIONS iterations
+        - position_rmse / yaw_rmse: RMSE of the estimated pose against HAL.pose
+          after convergence
+        - scan_cache_hit_rate: fraction of the particle scans reused from the workers' scan caches
+        - cascade_survival_rates: fraction of the particles that survived each stage of the cascade
+
+    Usage:
+        python3 benchmark_localization.py --particles 500 2000 --strides 15 5 --workers 1 4
+"""
+
+import argparse
+import contextlib
+import itertools
+import json
+import multiprocessing as mp
+import sys
+import time
+import numpy as np
+
+import MAP
+from HAL import HAL, SimulatedClock
+import MonteCarloLaserLocalization as mcl
+
+# Simulated time between two filter iterations (seconds)
+SIM_DT = 0.1
+
+# Distance (meters) to the real position to consider the filter converged,
+# for at least CONVERGENCE_ITERATIONS consecutive iterations
+CONVERGENCE_DISTANCE = 0.25
+CONVERGENCE_ITERATIONS = 10
+
+# Start pose of the robot (world coordinates) for all the trajectories
+START_POSE = [1.1, MAP.ROBOT_START_POSITION[1], MAP.ROBOT_START_POSITION[2]]
+
+# Scripted trajectories: list of (iterations, linear velocity, angular velocity)
+# segments, repeated until the end of the run
+TRAJECTORIES = {
+    "circle": [(1, mcl.LINEAR_VEL, mcl.ANGULAR_VEL)],
+    "slow_circle": [(1, 0.3, 0.8)],
+    "figure_eight": [(80, 0.5, 0.8), (80, 0.5, -0.8)],
+}
+
+
+def trajectory_velocities(trajectory, n_iterations):
+    """ Returns the (linear, angular) velocity of each iteration of a trajectory """
+    segments = itertools.cycle(TRAJECTORIES[trajectory])
+    velocities = []
+    while len(velocities) < n_iterations:
+        iterations, linear_vel, angular_vel = next(segments)
+        velocities.extend([(linear_vel, angular_vel)] * iterations)
+    return velocities[:n_iterations]
+
+
+def convergence_iteration(position_errors):
+    """ Returns the first iteration where the position error stays below
+        CONVERGENCE_DISTANCE for CONVERGENCE_ITERATIONS iterations (None if never).
+    """
+    below = (position_errors < CONVERGENCE_DISTANCE).astype(int)
+    # Number of iterations below the distance in each window
+    windows = np.convolve(below, np.ones(CONVERGENCE_ITERATIONS, dtype=int), mode='valid')
+    converged = np.flatnonzero(windows == CONVERGENCE_ITERATIONS)
+    return int(converged[0]) if converged.size > 0 else None
+
+
+@contextlib.contextmanager
+def filter_settings(**settings):
+    """ Set module globals of the filter (e.g. LASER_SAMPLING_STEP) in the with block.
+        The previous values are restored when leaving it, so runs do not affect each other.
+    """
+    previous = {name: getattr(mcl, name) for name in settings}
+    try:
+        for name, value in settings.items():
+            setattr(mcl, name, value)
+        yield
+    finally:
+        for name, value in previous.items():
+            setattr(mcl, name, value)
+
+
+def run_localization(n_particles, beam_stride, n_workers, trajectory, n_iterations, seed):
+    """ Run the particle filter along a trajectory and return its metrics """
+    # Configure the filter only for this run. The motion model reads the velocities
+    # from the module, so they are restored too
+    with filter_settings(MAX_PARTICLES=n_particles, N_PARTICLES=n_particles,
+                         MIN_PARTICLES=min(mcl.MIN_PARTICLES, n_particles),
+                         LASER_SAMPLING_STEP=beam_stride, rng=np.random.default_rng(seed),
+                         LINEAR_VEL=mcl.LINEAR_VEL, ANGULAR_VEL=mcl.ANGULAR_VEL):
+        return run_filter(n_particles, beam_stride, n_workers, trajectory, n_iterations, seed)
+
+
+def run_filter(n_particles, beam_stride, n_workers, trajectory, n_iterations, seed):
+    """ Run the particle filter configured in the module (see run_localization) """
+
+    # The robot and the particles advance SIM_DT seconds per iteration
+    robot = HAL(initial_pos=START_POSE, clock=SimulatedClock(SIM_DT))
+    if mcl.USE_SPHERE_TRACING:
+        robot.useSphereTracing()
+    velocities = trajectory_velocities(trajectory, n_iterations)
+
+    position_errors = []
+    yaw_errors = []
+    mcl.worker_stats.clear()
+    block_names = mcl.create_shared_arrays(n_particles)
+    try:
+        particle_set = mcl.ParticleSet(n_particles, pose_buffer=mcl.shared_arrays["particles"])
+        particle_set.setPoses(mcl.initialize_particles())
+        with mp.Pool(processes=n_workers, initializer=mcl.init_worker,
+                     initargs=(block_names, n_particles, mcl.worker_settings())) as pool:
+            start_time = time.perf_counter()
+            for linear_vel, angular_vel in velocities:
+                # Move the robot SIM_DT seconds and propagate the particles the same
+                robot.setV(linear_vel)
+                robot.setW(angular_vel)
+                robot.step()
+                mcl.LINEAR_VEL, mcl.ANGULAR_VEL = linear_vel, angular_vel
+                particle_set.propagate(SIM_DT)
+
+                # Measurement and resampling steps
+                robot_laser_data = robot.getLaserData()
+                mcl.update_particle_weights(pool, particle_set, robot_laser_data, robot.getPose(), n_workers)
+                mcl.resample_if_degenerate(particle_set)
+
+                # Error of the estimated pose
+                estimated_pose = particle_set.estimatePose()
+                real_pose = np.asarray(robot.getPose())
+                position_errors.append(np.linalg.norm(estimated_pose[:2] - real_pose[:2]))
+                yaw_error = np.mod(estimated_pose[2] - real_pose[2] + np.pi, 2 * np.pi) - np.pi
+                yaw_errors.append(yaw_error)
+            elapsed_time = time.perf_counter() - start_time
+            final_particles = particle_set.size
+    finally:
+        mcl.release_shared_arrays()
+
+    position_errors = np.array(position_errors)
+    yaw_errors = np.array(yaw_errors)
+    first = convergence_iteration(position_errors)
+    result = {
+        "particles": n_particles,
+        "beam_stride": beam_stride,
+        "workers": n_workers,
+        "trajectory": trajectory,
+        "seed": seed,
+        "iterations": n_iterations,
+        "final_particles": int(final_particles),
+        "iterations_per_second": n_iterations / elapsed_time,
+        "convergence_iteration": None,
+        "convergence_time": None,
+        "position_rmse": None,
+        "yaw_rmse": None,
+        "scan_cache_hit_rate": mcl.scan_cache_totals()["hit_rate"],
+        "cascade_survival_rates": mcl.cascade_survival_rates(),
+    }
+    if first is not None:
+        result["convergence_iteration"] = first
+        result["convergence_time"] = round((first + 1) * SIM_DT, 6)
+        result["position_rmse"] = float(np.sqrt(np.mean(position_errors[first:] ** 2)))
+        result["yaw_rmse"] = float(np.sqrt(np.mean(yaw_errors[first:] ** 2)))
+    return result
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Headless Monte Carlo localization benchmark")
+    parser.add_argument("--particles", type=int, nargs="+", default=[mcl.MAX_PARTICLES],
+                        help="max number of particles of each configuration")
+    parser.add_argument("--strides", type=int, nargs="+", default=[mcl.LASER_SAMPLING_STEP],
+                        help="laser beam strides of each configuration")
+    parser.add_argument("--workers", type=int, nargs="+", default=[mcl.N_WORKERS],
+                        help="number of workers of each configuration")
+    parser.add_argument("--trajectories", nargs="+", default=["circle"], choices=sorted(TRAJECTORIES))
+    parser.add_argument("--seeds", type=int, nargs="+", default=[0])
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--output", help="JSON file to write the results (stdout by default)")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    results = []
+    for n_particles, stride, n_workers, trajectory, seed in itertools.product(
+            args.particles, args.strides, args.workers, args.trajectories, args.seeds):
+        result = run_localization(n_particles, stride, n_workers, trajectory, args.iterations, seed)
+        print(F"{trajectory} particles={n_particles} stride={stride} workers={n_workers} seed={seed}: "
+              F"{result['iterations_per_second']:.1f} it/s, converged at {result['convergence_time']} s, "
+              F"RMSE {result['position_rmse']}", file=sys.stderr)
+        results.append(result)
+
+    report = json.dumps({"sim_dt": SIM_DT, "convergence_distance": CONVERGENCE_DISTANCE,
+                         "convergence_iterations": CONVERGENCE_ITERATIONS,
+                         "results": results}, indent=2)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(report + "\n")
+    else:
+        print(report)
+
+if __name__ == '__main__':
+    main()
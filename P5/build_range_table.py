@@ -0,0 +1,65 @@
+""" Offline builder of the range lookup table used by the HAL.
+
+    The map and the laser are fixed, so the range of every beam that the HAL
+    can cast is computed here once for every free cell of the map and every
+    discretized heading. The table is stored as a .npy file that the HAL opens
+    as a memory map (see HAL.loadRangeTable), so all the processes share it
+    through the OS page cache.
+
+    Usage:
+        python3 build_range_table.py [output_file]
+"""
+
+import sys
+import time
+import numpy as np
+
+import MAP
+from HAL import HAL, MAX_LASER_DISTANCE, OBSTACLE_VALUE, RANGE_TABLE_FILE, \
+    RANGE_TABLE_HEADINGS, RANGE_TABLE_RESOLUTION, RANGE_TABLE_NO_HIT
+
+# Number of free cells cast together in each chunk
+CELLS_PER_CHUNK = 256
+
+
+def build_range_table(table_file=RANGE_TABLE_FILE, cells_per_chunk=CELLS_PER_CHUNK):
+    """ Cast every heading from every free cell of the map and store the ranges
+        (in 1/RANGE_TABLE_RESOLUTION cells) in table_file.
+    """
+    hal = HAL()
+    # Free cells in row-major order (same order used by HAL.useRangeTable)
+    free_y, free_x = np.nonzero(hal.map_array != OBSTACLE_VALUE)
+    n_free = free_x.shape[0]
+    table = np.lib.format.open_memmap(table_file, mode='w+', dtype=np.uint16,
+                                      shape=(n_free, RANGE_TABLE_HEADINGS))
+
+    # Convert max laser detection distance from meters to map cells
+    laser_distance_cells = MAX_LASER_DISTANCE * MAP.MAP_SCALE
+    headings = np.radians(np.arange(RANGE_TABLE_HEADINGS))
+    for first in range(0, n_free, cells_per_chunk):
+        start_x = np.repeat(free_x[first:first + cells_per_chunk], RANGE_TABLE_HEADINGS)
+        start_y = np.repeat(free_y[first:first + cells_per_chunk], RANGE_TABLE_HEADINGS)
+        angles = np.tile(headings, start_x.shape[0] // RANGE_TABLE_HEADINGS)
+        end_x = start_x + laser_distance_cells * np.cos(angles)
+        end_y = start_y + laser_distance_cells * np.sin(angles)
+        laser_xy = hal.virtual_laser_beams(start_x, start_y, end_x, end_y)
+
+        ranges = np.hypot(laser_xy[:, 0] - start_x, laser_xy[:, 1] - start_y)
+        no_hit = ~np.isfinite(ranges)
+        ranges[no_hit] = 0
+        ranges = np.rint(ranges * RANGE_TABLE_RESOLUTION).astype(np.uint16)
+        ranges[no_hit] = RANGE_TABLE_NO_HIT
+        table[first:first + cells_per_chunk] = ranges.reshape(-1, RANGE_TABLE_HEADINGS)
+
+    table.flush()
+    return table
+
+
+def main():
+    table_file = sys.argv[1] if len(sys.argv) > 1 else RANGE_TABLE_FILE
+    start_time = time.time()
+    table = build_range_table(table_file)
+    print(F"Range table {table.shape} saved to {table_file} in {time.time() - start_time:.1f} s")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+""" Low-overhead stage profiling of the Monte Carlo localization loop.
+
+    Stages are timed with time.perf_counter_ns:
+
+        profiler = StageProfiler()
+        with profiler.stage("propagate"):
+            propagate_particles(particle_set)
+        print(profiler.formatSummary())
+
+    StageProfiler keeps the last durations of each stage in a fixed-size ring buffer
+    and summarizes them as rolling percentiles. StageRecorder only collects
+    (stage, nanoseconds) pairs, to send them from the workers to the main process.
+"""
+
+import json
+import time
+from contextlib import contextmanager
+import numpy as np
+
+# Number of durations kept per stage for the rolling percentiles
+PROFILE_WINDOW = 256
+
+# Percentiles reported in the summaries
+PROFILE_PERCENTILES = (50, 90, 99)
+
+
+class StageRecorder:
+    """ Records the duration of named stages as (stage, nanoseconds) pairs.
+        Disabled recorders time nothing.
+    """
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.records = []
+
+    @contextmanager
+    def stage(self, name):
+        """ Time the body of the with block as stage "name" """
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter_ns() - start)
+
+    def record(self, name, elapsed_ns):
+        self.records.append((name, elapsed_ns))
+
+    def takeRecords(self):
+        """ Returns the records collected since the last call and forgets them """
+        records = self.records
+        self.records = []
+        return records
+
+
+class StageProfiler(StageRecorder):
+    """ Rolling statistics of the duration of named stages.
+        The last "window" durations of each stage are kept in a ring buffer,
+        so memory and summary cost do not grow with the run length.
+    """
+    def __init__(self, window=PROFILE_WINDOW, enabled=True):
+        super().__init__(enabled)
+        self.window = window
+        self.durations = {}
+        self.counts = {}
+        self.totals = {}
+
+    def record(self, name, elapsed_ns):
+        if name not in self.durations:
+            self.durations[name] = np.zeros(self.window, dtype=np.int64)
+            self.counts[name] = 0
+            self.totals[name] = 0
+        self.durations[name][self.counts[name] % self.window] = elapsed_ns
+        self.counts[name] += 1
+        self.totals[name] += elapsed_ns
+
+    def recordAll(self, records):
+        """ Add (stage, nanoseconds) pairs, e.g. taken from a StageRecorder """
+        for name, elapsed_ns in records:
+            self.record(name, elapsed_ns)
+
+    def summary(self):
+        """ Statistics of each stage in milliseconds: total count and time,
+            and mean and percentiles of the durations in the window
+        """
+        summary = {}
+        for name, durations in self.durations.items():
+            window_ms = durations[:min(self.counts[name], self.window)] / 1e6
+            stats = {
+                "count": self.counts[name],
+                "total_ms": self.totals[name] / 1e6,
+                "mean_ms": float(np.mean(window_ms)),
+            }
+            for percentile, value in zip(PROFILE_PERCENTILES, np.percentile(window_ms, PROFILE_PERCENTILES)):
+                stats[F"p{percentile}_ms"] = float(value)
+            summary[name] = stats
+        return summary
+
+    def formatSummary(self):
+        """ Summary as a text table, one stage per row (slowest first) """
+        summary = self.summary()
+        columns = ["count", "total_ms", "mean_ms"] + [F"p{p}_ms" for p in PROFILE_PERCENTILES]
+        width = max([len("stage")] + [len(name) for name in summary])
+        lines = ["  ".join([F"{'stage':<{width}}"] + [F"{column:>10}" for column in columns])]
+        for name, stats in sorted(summary.items(), key=lambda item: -item[1]["total_ms"]):
+            values = [F"{stats['count']:>10d}"] + [F"{stats[column]:>10.3f}" for column in columns[1:]]
+            lines.append("  ".join([F"{name:<{width}}"] + values))
+        return "\n".join(lines)
+
+    def dump(self, output_file):
+        """ Write the summary in a JSON file """
+        with open(output_file, "w") as output:
+            json.dump(self.summary(), output, indent=2)